@@ -5,6 +5,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import importlib
 import os
 import sys
 from pathlib import PosixPath
@@ -17,5 +18,12 @@ DATA_DIR =(
     os.path.join(PosixPath(__file__).absolute().parents[1].as_posix(), 'data')
 )
 
-#changed the relative import statement to an absolute import to fix "no known parent package" error
-from blamepipeline import claimclass
+# Subpackages (and torch, allennlp, numpy behind them) are imported on first access.
+_SUBPACKAGES = {'blameextract', 'claimclass', 'entityclass', 'simplebaseline',
+                'tokenizers', 'preprocess', 'embeddings', 'pipeline', 'service'}
+
+
+def __getattr__(name):
+    if name in _SUBPACKAGES:
+        return importlib.import_module('blamepipeline.' + name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
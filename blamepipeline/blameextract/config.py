@@ -25,7 +25,8 @@ MODEL_ARCHITECTURE = {
 MODEL_OPTIMIZER = {
     'fix_embeddings', 'optimizer', 'learning_rate', 'momentum', 'weight_decay',
     'rnn_padding', 'dropout_rnn', 'dropout_cnn', 'dropout_rnn_output', 'dropout_emb',
-    'grad_clipping', 'dropout_feature', 'dropout_final', 'pos_weight', 'xavier_init'
+    'grad_clipping', 'dropout_feature', 'dropout_final', 'pos_weight', 'xavier_init',
+    'article_mode'
 }
 
 
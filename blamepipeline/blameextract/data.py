@@ -9,12 +9,17 @@
 """Data processing/loading helpers."""
 
 import logging
+import os
+import shutil
 import unicodedata
 
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import Sampler
+from blamepipeline.blameextract.vector import SentenceSpans
 from blamepipeline.blameextract.vector import vectorize
+from blamepipeline.blameextract.vector import vectorize_article
 
 logger = logging.getLogger(__name__)
 
@@ -100,6 +105,98 @@ class BlameTieDataset(Dataset):
         return vectorize(self.examples[index], self.model, uncased=self.uncased)
 
 
+class BlameArticleDataset(Dataset):
+    """Articles of utils.group_articles, batched by vector.batchify_articles."""
+
+    def __init__(self, articles, model, uncased=False):
+        self.model = model
+        self.articles = articles
+        self.uncased = uncased
+
+    def __len__(self):
+        return len(self.articles)
+
+    def __getitem__(self, index):
+        return vectorize_article(self.articles[index], self.model, uncased=self.uncased)
+
+
+def compile_examples(examples, model, path, uncased=False):
+    """Vectorize examples once and save them as arrays in directory path.
+
+    Sentences shared by examples (those of one article) are stored once.
+    Entity masking (unk_entity) is left to CompiledBlameTieDataset.
+    """
+    word_dict = model.word_dict
+    entity_dict = model.entity_dict
+    arrays = {name: [] for name in ('words', 'sent_offsets', 'ex_sents', 'ex_sents_ptr',
+                                    'ents', 'labels', 'spos', 'spos_ptr', 'tpos', 'tpos_ptr')}
+    arrays['sent_offsets'].append(0)
+    for name in ('ex_sents_ptr', 'spos_ptr', 'tpos_ptr'):
+        arrays[name].append(0)
+    sent_ids = {}
+    for ex in examples:
+        for s in ex['sents']:
+            if id(s) not in sent_ids:
+                sent_ids[id(s)] = len(arrays['sent_offsets']) - 1
+                arrays['words'].extend(word_dict[w.lower() if uncased else w] for w in s)
+                arrays['sent_offsets'].append(len(arrays['words']))
+            arrays['ex_sents'].append(sent_ids[id(s)])
+        arrays['ex_sents_ptr'].append(len(arrays['ex_sents']))
+        arrays['ents'].append((entity_dict[ex['src']], entity_dict[ex['tgt']]))
+        arrays['labels'].append(ex.get('label', -1))
+        for name, key in (('spos', 'src_pos'), ('tpos', 'tgt_pos')):
+            arrays[name].extend(tuple(p) for p in ex[key])
+            arrays[name + '_ptr'].append(len(arrays[name]))
+
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, values in arrays.items():
+        values = np.array(values, dtype=np.int64)
+        if name in ('ents', 'spos', 'tpos'):
+            values = values.reshape(-1, 2)
+        np.save(os.path.join(tmp_path, name + '.npy'), values)
+    os.replace(tmp_path, path)
+
+
+class CompiledBlameTieDataset(Dataset):
+    """BlameTieDataset read from the arrays of compile_examples.
+
+    The arrays are memory mapped. An example holds slices of them, its
+    sentences as spans of the words array, which vector.batchify copies
+    into the batch at once.
+    """
+
+    def __init__(self, path, unk_entity=False):
+        self.unk_entity = unk_entity
+        for name in ('words', 'spos', 'tpos'):
+            # plain ndarray views slice faster than np.memmap
+            array = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            setattr(self, name, array.view(np.ndarray))
+        for name in ('sent_offsets', 'ex_sents'):
+            setattr(self, name, np.load(os.path.join(path, name + '.npy')))
+        # one or a few numbers per example, indexed as lists
+        for name in ('ex_sents_ptr', 'ents', 'labels', 'spos_ptr', 'tpos_ptr'):
+            setattr(self, name, np.load(os.path.join(path, name + '.npy')).tolist())
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        sent_ids = self.ex_sents[self.ex_sents_ptr[index]: self.ex_sents_ptr[index + 1]]
+        spans = np.stack([self.sent_offsets[sent_ids], self.sent_offsets[sent_ids + 1]], 1)
+        sents = SentenceSpans(self.words, spans, self.unk_entity)
+        spos = self.spos[self.spos_ptr[index]: self.spos_ptr[index + 1]]
+        tpos = self.tpos[self.tpos_ptr[index]: self.tpos_ptr[index + 1]]
+        src_idx, tgt_idx = self.ents[index]
+        label = self.labels[index]
+        # Sentences are only needed as words for elmo, which is not compiled
+        if label < 0:
+            return src_idx, tgt_idx, spos, tpos, sents, None
+        else:
+            return src_idx, tgt_idx, spos, tpos, sents, None, label
+
+
 # ------------------------------------------------------------------------------
 # PyTorch sampler
 # ------------------------------------------------------------------------------
@@ -7,8 +7,6 @@
 # @Last Modified time: 2018-06-01 18:01:11
 """Implementation of the Blame Extractor Class."""
 
-import random
-
 import torch
 import torch.nn as nn
 '''
@@ -101,15 +99,19 @@ class LSTMContextClassifier(nn.Module):
             if args.xavier_init:
                 nn.init.xavier_uniform(self.linear.weight)
 
-    def forward(self, x, x_mask, ents, batch_spos, batch_tpos, batch_sent_chars):
+    def forward(self, x, x_mask, ents, mentions, batch_sent_chars, pairs=None):
         """Inputs:
         x = sentence word indices             [sents * len]
         x_mask = sentence padding mask        [sents * len]
         ents: batch x 2
+        mentions: entity mentions             [mentions * 4]
+            (sentence, word, segment, slot), segment 2i is the source of
+            pair i and 2i + 1 its target, slot numbers the segment's mentions
+        pairs: None, or (source, target) of every pair to score [pairs * 2]
+            article mode: ents are then the entities [entities], the segment
+            of a mention is its entity and each entity is pooled once for
+            all the pairs it is in
         """
-        if self.args.entity_embs:
-            e_embs = self.ent_embedding(ents)  # batch x 2 x emb
-            e_embs = e_embs.view(e_embs.size(0), -1)
         if self.args.pretrain_file != 'elmo':
             x_emb = self.embedding(x)
         else:
@@ -131,29 +133,42 @@ class LSTMContextClassifier(nn.Module):
         else:
             sent_hiddens = x_emb
 
-        batch_feats = []
-
-        for batch_i, (spos, tpos) in enumerate(zip(batch_spos, batch_tpos)):
-            # find entity hidden representation
-            if self.args.pooling == 'mean':
-                s_hids_pool = torch.stack([sent_hiddens[tuple(pos)] for pos in spos], dim=0).mean(0)
-                t_hids_pool = torch.stack([sent_hiddens[tuple(pos)] for pos in tpos], dim=0).mean(0)
-            elif self.args.pooling == 'max':
-                s_hids_pool = torch.stack([sent_hiddens[tuple(pos)] for pos in spos], dim=0).max(0)[0]
-                t_hids_pool = torch.stack([sent_hiddens[tuple(pos)] for pos in tpos], dim=0).max(0)[0]
-            elif self.args.pooling == 'attn':
-                s_hids_pool = self._attention_pooling(torch.stack([sent_hiddens[tuple(pos)] for pos in spos], dim=0))
-                t_hids_pool = self._attention_pooling(torch.stack([sent_hiddens[tuple(pos)] for pos in tpos], dim=0))
-            else:
-                # self.args.pooling == 'rand':
-                s_hids_pool = sent_hiddens[tuple(random.choice(spos))]
-                t_hids_pool = sent_hiddens[tuple(random.choice(tpos))]
-            feats = [s_hids_pool, t_hids_pool]
-            if self.args.entity_embs:
-                feats.append(e_embs[batch_i])
-            batch_feats.append(torch.cat(feats, dim=0))
-
-        batch_feats = torch.stack(batch_feats, dim=0)
+        # find entity hidden representation, the mentions of all entities at once
+        if pairs is None:
+            batch_size = ents.size(0)
+            num_segments = 2 * batch_size
+        else:
+            batch_size = pairs.size(0)
+            num_segments = ents.size(0)
+        segments, slots = mentions[:, 2], mentions[:, 3]
+        mention_hids = sent_hiddens[mentions[:, 0], mentions[:, 1]]  # mentions x hid
+        counts = mentions.new_zeros(num_segments).index_add_(0, segments, torch.ones_like(segments))
+        max_slots = counts.max().item()
+        # segments x slots x hid, padded with zeros
+        hids = mention_hids.new_zeros(num_segments, max_slots, mention_hids.size(1))
+        hids[segments, slots] = mention_hids
+        padding = torch.arange(max_slots, device=counts.device).unsqueeze(0) >= counts.unsqueeze(1)
+        if self.args.pooling == 'mean':
+            hids_pool = hids.sum(1) / counts.unsqueeze(1).type_as(hids)
+        elif self.args.pooling == 'max':
+            hids_pool = hids.masked_fill(padding.unsqueeze(2), -float('inf')).max(1)[0]
+        elif self.args.pooling == 'attn':
+            hids_pool = self._attention_pooling(hids, padding)
+        else:
+            # self.args.pooling == 'rand':
+            pick = (torch.rand(counts.size(), device=counts.device) * counts.type_as(hids)).long()
+            hids_pool = hids[torch.arange(num_segments, device=counts.device), pick]
+        if pairs is not None:
+            # the segments and entities of the pairs
+            hids_pool = hids_pool[pairs]
+            ents = ents[pairs]
+        # batch x (source hid + target hid)
+        feats = [hids_pool.view(batch_size, -1)]
+        if self.args.entity_embs:
+            e_embs = self.ent_embedding(ents)  # batch x 2 x emb
+            feats.append(e_embs.view(batch_size, -1))
+        batch_feats = torch.cat(feats, dim=1)
+
         if self.args.dropout_feature > 0:
             batch_feats = nn.functional.dropout(batch_feats, p=self.args.dropout_feature,
                                                 training=self.training)
@@ -168,10 +183,12 @@ class LSTMContextClassifier(nn.Module):
 
         return score
 
-    def _attention_pooling(self, var):
+    def _attention_pooling(self, var, padding):
+        """var: segments x slots x hid, padding: segments x slots"""
         energy = nn.functional.tanh(self.attw(var))
-        weights = nn.functional.softmax(self.attw2(energy), dim=0)
-        return (weights.expand_as(var) * var).sum(0)
+        scores = self.attw2(energy).masked_fill(padding.unsqueeze(2), -float('inf'))
+        weights = nn.functional.softmax(scores, dim=1)
+        return (weights.expand_as(var) * var).sum(1)
 
 
 class EntityClassifier(nn.Module):
@@ -188,7 +205,9 @@ class EntityClassifier(nn.Module):
             nn.init.xavier_uniform(self.condense_feature.weight)
             nn.init.xavier_uniform(self.linear.weight)
 
-    def forward(self, x, x_mask, ents, batch_spos, batch_tpos, batch_sent_chars):
+    def forward(self, x, x_mask, ents, mentions, batch_sent_chars, pairs=None):
+        if pairs is not None:
+            ents = ents[pairs]
         batch_size = ents.size(0)
         e_embs = self.ent_embedding(ents).view(batch_size, -1)
         condensed_feats = self.condense_feature(e_embs)
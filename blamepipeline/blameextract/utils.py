@@ -7,7 +7,9 @@
 # @Last Modified time: 2018-06-01 17:19:48
 """Blame Extractor utilities."""
 
+import hashlib
 import json
+import os
 import time
 import logging
 import random
@@ -17,6 +19,9 @@ import torch
 
 from blamepipeline.blameextract.data import Dictionary
 from blamepipeline.blameextract.data import BlameTieDataset
+from blamepipeline.blameextract.data import BlameArticleDataset
+from blamepipeline.blameextract.data import CompiledBlameTieDataset
+from blamepipeline.blameextract.data import compile_examples
 from blamepipeline.blameextract.data import SubsetWeightedRandomSampler
 from blamepipeline.blameextract import vector
 
@@ -27,12 +32,40 @@ logger = logging.getLogger(__name__)
 # Train/dev split
 # ------------------------------------------------------------------------------
 
+def make_dataset(examples, args, model, filename=None):
+    """BlameTieDataset of examples loaded from filename. Read from its compiled
+    arrays in args.data_cache, compiled on first use, unless elmo needs the words.
+    """
+    if not filename or not args.data_cache or args.pretrain_file == 'elmo':
+        return BlameTieDataset(examples, model, uncased=args.uncased)
+    path = os.path.join(args.data_cache, dataset_key(filename, examples, model, uncased=args.uncased))
+    if not os.path.exists(path):
+        logger.info(f'Compile {filename} to {path}')
+        os.makedirs(args.data_cache, exist_ok=True)
+        compile_examples(examples, model, path, uncased=args.uncased)
+    return CompiledBlameTieDataset(path, unk_entity=model.args.unk_entity)
+
+
+def dataset_key(filename, examples, model, uncased=False):
+    """Hash of everything compiled examples depend on."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    # examples may be a prefix of the file (debug)
+    h.update(f'{len(examples)} {uncased}'.encode('utf-8'))
+    for dictionary in (model.word_dict, model.entity_dict):
+        h.update('\n'.join(dictionary.ind2tok[i] for i in range(len(dictionary))).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
 def split_loader(train_exs, test_exs, args, model, dev_exs=None, weighted=False):
-    train_dataset = BlameTieDataset(train_exs, model)
+    train_dataset = make_dataset(train_exs, args, model, args.train_file)
     train_size = len(train_dataset)
     train_idxs = list(range(train_size))
 
-    test_dataset = BlameTieDataset(test_exs, model)
+    test_dataset = make_dataset(test_exs, args, model, args.test_file)
     test_sampler = torch.utils.data.sampler.SequentialSampler(test_dataset)
     test_loader = torch.utils.data.DataLoader(
         test_dataset,
@@ -43,7 +76,7 @@ def split_loader(train_exs, test_exs, args, model, dev_exs=None, weighted=False)
         pin_memory=args.cuda)
 
     if dev_exs:
-        dev_dataset = BlameTieDataset(dev_exs, model)
+        dev_dataset = make_dataset(dev_exs, args, model, args.dev_file)
         dev_sampler = torch.utils.data.sampler.SequentialSampler(dev_dataset)
         dev_loader = torch.utils.data.DataLoader(
             dev_dataset,
@@ -92,8 +125,39 @@ def split_loader(train_exs, test_exs, args, model, dev_exs=None, weighted=False)
     return train_loader, dev_loader, test_loader
 
 
+def split_loader_articles(train_exs, test_exs, args, model, dev_exs=None):
+    """Loaders of whole articles (article mode), the dev split is by article."""
+    train_articles = group_articles(train_exs)
+    test_articles = group_articles(test_exs)
+    if dev_exs:
+        dev_articles = group_articles(dev_exs)
+    else:
+        random.shuffle(train_articles)
+        dev_size = int(len(train_articles) * args.valid_size)
+        dev_articles = train_articles[len(train_articles) - dev_size:]
+        train_articles = train_articles[:len(train_articles) - dev_size]
+
+    loaders = []
+    for articles, batch_size, shuffle in ((train_articles, args.batch_size, True),
+                                          (dev_articles, args.test_batch_size, False),
+                                          (test_articles, args.test_batch_size, False)):
+        loaders.append(torch.utils.data.DataLoader(
+            BlameArticleDataset(articles, model, uncased=args.uncased),
+            batch_size=batch_size,
+            shuffle=shuffle,
+            num_workers=args.data_workers,
+            collate_fn=vector.batchify_articles,
+            pin_memory=args.cuda))
+
+    if args.debug:
+        # dev and test vocabulary coverage in train
+        vocab_coverage(args, model, train_articles, dev_articles, test_articles)
+
+    return tuple(loaders)
+
+
 def split_loader_cv(train_exs, args, model, test_idxs, weighted=False):
-    train_dataset = BlameTieDataset(train_exs, model)
+    train_dataset = make_dataset(train_exs, args, model, args.train_file)
     train_idxs = list(set(range(len(train_dataset))) - set(test_idxs))
     random.shuffle(train_idxs)
     train_idxs_ = train_idxs[:int(len(train_idxs) * (1 - args.valid_size))]
@@ -162,15 +226,58 @@ def vocab_coverage(args, model, train_exs, dev_exs, test_exs):
 
 def load_data(filename):
     """Load examples from preprocessed file.
-    One example per line, JSON encoded.
+    One record per line, JSON encoded: an article ({'id', 'sents'}) before
+    the examples that refer to it ({'article', 'sent_ids', ...}).
+    The sentences of an example are shared with its article, not copied.
     """
-    # Load JSON lines
+    examples = []
+    articles = {}
     with open(filename) as f:
-        examples = [json.loads(line) for line in f]
+        for line in f:
+            record = json.loads(line)
+            if 'src' not in record:
+                articles[record['id']] = record['sents']
+                continue
+            if 'article' in record:
+                sents = articles[record['article']]
+                record['sents'] = [sents[si] for si in record['sent_ids']]
+            examples.append(record)
 
     return examples
 
 
+def group_articles(examples):
+    """Group examples of load_data by article, for article mode.
+    An article holds the sentences of its entity mentions, its entities with
+    the positions of their mentions in these sentences ({entity: [(sentence,
+    word)]}), and its pairs: (source, target) indices in entities, labeled
+    if the examples are.
+    """
+    articles = {}
+    for ex in examples:
+        if 'article' not in ex:
+            raise RuntimeError('Article mode needs samples with article records, '
+                               'rerun prepare_data.')
+        if ex['article'] not in articles:
+            articles[ex['article']] = ({'id': ex['article'], 'sents': [], 'entities': [],
+                                        'epos': {}, 'pairs': []}, {}, {})
+        article, sent_rows, ent_idxs = articles[ex['article']]
+        for sent_id, sent in zip(ex['sent_ids'], ex['sents']):
+            if sent_id not in sent_rows:
+                sent_rows[sent_id] = len(article['sents'])
+                article['sents'].append(sent)
+        for e, pos in ((ex['src'], ex['src_pos']), (ex['tgt'], ex['tgt_pos'])):
+            if e not in ent_idxs:
+                ent_idxs[e] = len(article['entities'])
+                article['entities'].append(e)
+                article['epos'][e] = [(sent_rows[ex['sent_ids'][si]], wi) for si, wi in pos]
+        article['pairs'].append((ent_idxs[ex['src']], ent_idxs[ex['tgt']]))
+        if 'label' in ex:
+            article.setdefault('labels', []).append(ex['label'])
+
+    return [article for article, _, _ in articles.values()]
+
+
 # ------------------------------------------------------------------------------
 # Dictionary building
 # ------------------------------------------------------------------------------
@@ -7,8 +7,16 @@
 # @Last Modified time: 2018-06-02 00:28:59
 """Functions for putting examples into torch format."""
 
+import collections
+
+import numpy as np
 import torch
 
+# Sentences of a compiled example: (start, end) spans of words, the word
+# indices of all the examples. If masked, the entity mentions of the example
+# are replaced by Dictionary.NULL (index 0) when batched.
+SentenceSpans = collections.namedtuple('SentenceSpans', ['words', 'spans', 'masked'])
+
 
 def vectorize(ex, model, uncased=False):
     """Torchify a single example."""
@@ -18,10 +26,10 @@ def vectorize(ex, model, uncased=False):
     sentences = [[w.lower() for w in s] for s in ex['sents']] if uncased else ex['sents']
     src, tgt = ex['src'], ex['tgt']
     spos, tpos = ex['src_pos'], ex['tgt_pos']
-    label = ex['label']
 
     if model.args.unk_entity:
-        # mask the entity position
+        # mask the entity position, on a copy as examples share sentences
+        sentences = [list(s) for s in sentences]
         for si, wi in spos + tpos:
             sentences[si][wi] = '<NULL>'
     sents = [[word_dict[w] for w in s] for s in sentences]
@@ -33,7 +41,7 @@ def vectorize(ex, model, uncased=False):
     if 'label' not in ex:
         return src_idx, tgt_idx, spos, tpos, sents, sentences
     else:
-        return src_idx, tgt_idx, spos, tpos, sents, sentences, label
+        return src_idx, tgt_idx, spos, tpos, sents, sentences, ex['label']
 
 
 def batchify(batch):
@@ -46,33 +54,188 @@ def batchify(batch):
     else:
         pred_mode = True
 
-    # collate sentences and calculate sentence distance features
+    if isinstance(batch[0][4], SentenceSpans):
+        x, x_mask, ents, mentions = batchify_spans(batch)
+        if pred_mode:
+            return x, x_mask, ents, mentions, None
+        else:
+            return x, x_mask, ents, mentions, None, batch_labels
+
+    # collate sentences, each distinct sentence once: pairs of an article
+    # share their sentences, which are then encoded once
     batch_sents = []
     batch_sentences = []
+    sent_rows = {}
+    # batch row of every sentence of every example, example i's from offsets[i]
+    rows, offsets = [], []
     for _, _, _, _, sents, sentences in batch:
-        for sent in sents:
-            # if sent not in batch_sents:
-            batch_sents.append(sent)
-        for sent in sentences:
-            # if sent not in batch_sentences:
-            batch_sentences.append(sent)
-
-    from allennlp.modules.elmo import batch_to_ids
-    batch_sent_chars = batch_to_ids(batch_sentences)
-    # batch_sent_chars = None
-
-    # relocate the entity positions
-    batch_spos, batch_tpos = [], []
+        offsets.append(len(rows))
+        for i, sent in enumerate(sents):
+            key = tuple(sent)
+            if key not in sent_rows:
+                sent_rows[key] = len(batch_sents)
+                batch_sents.append(sent)
+                if sentences is not None:
+                    batch_sentences.append(sentences[i])
+            rows.append(sent_rows[key])
+
+    if batch[0][5] is not None:
+        from allennlp.modules.elmo import batch_to_ids
+        batch_sent_chars = batch_to_ids(batch_sentences)
+    else:
+        # compiled examples have no words, they are only used by elmo
+        batch_sent_chars = None
+
+    # relocate the entity positions: (sentence, word, segment, slot) of every
+    # mention, segment 2i holds the source mentions of example i, 2i + 1 the target's
+    batch_mentions = []
     batch_ents = []
-    for src_idx, tgt_idx, spos, tpos, sents, _ in batch:
-        spos = [(batch_sents.index(sents[si]), wi) for si, wi in spos]
-        tpos = [(batch_sents.index(sents[si]), wi) for si, wi in tpos]
-        batch_spos.append(spos)
-        batch_tpos.append(tpos)
+    for i, (offset, (src_idx, tgt_idx, spos, tpos, _, _)) in enumerate(zip(offsets, batch)):
+        for segment, pos in enumerate((spos, tpos), 2 * i):
+            for slot, (si, wi) in enumerate(pos):
+                batch_mentions.append((rows[offset + si], wi, segment, slot))
         batch_ents.append([src_idx, tgt_idx])
 
     ents = torch.LongTensor(batch_ents)
+    mentions = torch.LongTensor(batch_mentions)
+    x, x_mask = pad_sentences(batch_sents)
+
+    # Maybe return without targets
+    if pred_mode:
+        return x, x_mask, ents, mentions, batch_sent_chars
+    else:
+        return x, x_mask, ents, mentions, batch_sent_chars, batch_labels
+
+
+def batchify_spans(batch):
+    """Collate compiled examples, their sentences given as SentenceSpans.
+
+    A sentence is deduplicated by its span (and its masked words), and all the
+    sentences are copied out of the words array at once.
+
+    Returns:
+        x, x_mask, ents, mentions as in batchify.
+    """
+    words = batch[0][4].words
+    masked = batch[0][4].masked
+    # batch row of every sentence of every example, example i's from offsets[i]
+    sent_rows = {}
+    row_spans = []
+    rows, offsets = [], []
+    mask_rows, mask_words = [], []
+    for _, _, spos, tpos, sents, _ in batch:
+        offsets.append(len(rows))
+        masks = collections.defaultdict(set)
+        if masked:
+            for si, wi in spos.tolist() + tpos.tolist():
+                masks[si].add(wi)
+        for si, (start, end) in enumerate(sents.spans.tolist()):
+            key = (start, end, tuple(sorted(masks[si]))) if masked else (start, end)
+            row = sent_rows.get(key)
+            if row is None:
+                row = sent_rows[key] = len(row_spans)
+                row_spans.append((start, end))
+                mask_rows.extend([row] * len(masks[si]))
+                mask_words.extend(masks[si])
+            rows.append(row)
+
+    row_spans = np.array(row_spans, dtype=np.int64)
+    lengths = row_spans[:, 1] - row_spans[:, 0]
+    x = torch.zeros(len(row_spans), int(lengths.max()), dtype=torch.long)
+    x_mask = torch.ones(x.size(), dtype=torch.uint8)
+    cols = np.arange(x.size(1))
+    valid = cols < lengths[:, None]
+    x.numpy()[valid] = words[(row_spans[:, :1] + cols)[valid]]
+    x_mask.numpy()[valid] = 0
+    x.numpy()[mask_rows, mask_words] = 0
+
+    # (sentence, word, segment, slot) of every mention, segment 2i holds the
+    # source mentions of example i, 2i + 1 the target's
+    positions = [pos for ex in batch for pos in ex[2:4]]
+    counts = np.array([len(pos) for pos in positions])
+    starts = np.cumsum(counts) - counts
+    rows = np.array(rows, dtype=np.int64)
+    positions = np.concatenate(positions)
+    segments = np.repeat(np.arange(len(counts)), counts)
+    sent_offsets = np.repeat(np.array(offsets, dtype=np.int64), 2)[segments]
+    mentions = np.stack([rows[sent_offsets + positions[:, 0]], positions[:, 1],
+                         segments, np.arange(len(positions)) - starts[segments]], 1)
+
+    ents = torch.LongTensor([[ex[0], ex[1]] for ex in batch])
+    return x, x_mask, ents, torch.from_numpy(mentions)
+
+
+def vectorize_article(ex, model, uncased=False):
+    """Torchify a single article: its entities and all their pairs."""
+    word_dict = model.word_dict
+    entity_dict = model.entity_dict
+    sentences = [[w.lower() for w in s] for s in ex['sents']] if uncased else ex['sents']
+    entities = ex['entities']
+    epos = [ex['epos'][e] for e in entities]
+
+    if model.args.unk_entity:
+        # mask the positions of all the entities, each pair sees the others masked too
+        sentences = [list(s) for s in sentences]
+        for pos in epos:
+            for si, wi in pos:
+                sentences[si][wi] = '<NULL>'
+    sents = [[word_dict[w] for w in s] for s in sentences]
+
+    ents = [entity_dict[e] for e in entities]
+
+    # Maybe return without targets
+    if 'labels' not in ex:
+        return ents, epos, sents, sentences, ex['pairs']
+    else:
+        return ents, epos, sents, sentences, ex['pairs'], ex['labels']
 
+
+def batchify_articles(batch):
+    """Gather a batch of articles into one batch, each sentence encoded once
+    and every pair scored from the pooled states of its entities."""
+
+    pred_mode = len(batch[0]) == 5
+    batch_sents = []
+    batch_sentences = []
+    # (sentence, word, entity, slot) of every mention
+    batch_mentions = []
+    batch_ents = []
+    batch_pairs = []
+    batch_labels = []
+    for ex in batch:
+        ents, epos, sents, sentences, pairs = ex[:5]
+        sent_offset, ent_offset = len(batch_sents), len(batch_ents)
+        batch_sents.extend(sents)
+        if sentences is not None:
+            batch_sentences.extend(sentences)
+        for e, pos in enumerate(epos, ent_offset):
+            for slot, (si, wi) in enumerate(pos):
+                batch_mentions.append((sent_offset + si, wi, e, slot))
+        batch_ents.extend(ents)
+        batch_pairs.extend((ent_offset + src, ent_offset + tgt) for src, tgt in pairs)
+        if not pred_mode:
+            batch_labels.extend(ex[5])
+
+    if batch[0][3] is not None:
+        from allennlp.modules.elmo import batch_to_ids
+        batch_sent_chars = batch_to_ids(batch_sentences)
+    else:
+        batch_sent_chars = None
+
+    ents = torch.LongTensor(batch_ents)
+    mentions = torch.LongTensor(batch_mentions)
+    pairs = torch.LongTensor(batch_pairs)
+    x, x_mask = pad_sentences(batch_sents)
+
+    # Maybe return without targets
+    if pred_mode:
+        return x, x_mask, ents, mentions, batch_sent_chars, pairs
+    else:
+        return x, x_mask, ents, mentions, batch_sent_chars, pairs, torch.LongTensor(batch_labels)
+
+
+def pad_sentences(batch_sents):
+    """Return: word indices of batch_sents padded to the longest, and the padding mask."""
     max_length = max([len(s) for s in batch_sents])
     x = torch.zeros(len(batch_sents), max_length).long()
     x_mask = torch.ones(len(batch_sents), max_length).byte()
@@ -80,9 +243,4 @@ def batchify(batch):
     for i, s in enumerate(batch_sents):
         x[i, :len(s)].copy_(torch.Tensor(s).long())
         x_mask[i, :len(s)].fill_(0)
-
-    # Maybe return without targets
-    if pred_mode:
-        return x, x_mask, ents, batch_spos, batch_tpos, batch_sent_chars
-    else:
-        return x, x_mask, ents, batch_spos, batch_tpos, batch_sent_chars, batch_labels
+    return x, x_mask
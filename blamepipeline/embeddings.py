@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Pretrained word embeddings in a binary, memory-mapped format.
+
+A text embedding file (one word and its vector per line, space separated)
+is converted once into two .npy files next to it:
+    <name>.npy        float32 matrix, the vectors in file order
+    <name>.vocab.npy  (hash, row) of every line sorted by hash, where hash
+                      is the 8 byte blake2b digest of the NFD normalized word
+    <name>.source.json  size and modification time of the text file, the
+                      binary files are only used while they match
+Loading the embeddings of a dictionary is then a search in the sorted
+hashes and one gather of the rows, instead of parsing the whole text file.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import unicodedata
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VOCAB_DTYPE = np.dtype([('hash', '<u8'), ('row', '<i8')])
+
+
+def normalize(word):
+    """Normalize a word like the model dictionaries do."""
+    return unicodedata.normalize('NFD', word)
+
+
+def word_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def store_paths(embedding_file):
+    """Return: paths of the matrix, vocabulary and source stamp files of embedding_file."""
+    prefix = os.path.splitext(embedding_file)[0]
+    return prefix + '.npy', prefix + '.vocab.npy', prefix + '.source.json'
+
+
+def source_stamp(embedding_file):
+    stat = os.stat(embedding_file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def is_converted(embedding_file):
+    """Whether embedding_file was converted and has not changed since.
+
+    The binary files are trusted alone if the text file was removed.
+    """
+    if not all(os.path.exists(path) for path in store_paths(embedding_file)):
+        return False
+    if not os.path.exists(embedding_file):
+        return True
+    with open(store_paths(embedding_file)[2]) as f:
+        stamp = json.load(f)
+    if stamp != source_stamp(embedding_file):
+        logger.warning(f'{embedding_file} changed since it was converted, reading the text file. '
+                       f'Convert it again with script/preprocess/convert_embeddings.py')
+        return False
+    return True
+
+
+def convert(embedding_file):
+    """Convert a text embedding file to the binary format.
+
+    Args:
+        embedding_file: path to text file of embeddings, space separated.
+    Returns:
+        number of vectors and their dimension
+    """
+    matrix_file, vocab_file, stamp_file = store_paths(embedding_file)
+    # stamped before reading, a change during the conversion is detected
+    stamp = source_stamp(embedding_file)
+    if os.path.exists(stamp_file):
+        os.remove(stamp_file)
+    with open(embedding_file, encoding='utf-8') as f:
+        num = sum(1 for _ in f)
+    with open(embedding_file, encoding='utf-8') as f:
+        dim = len(f.readline().rstrip().split(' ')) - 1
+
+    matrix = np.lib.format.open_memmap(matrix_file + '.tmp', mode='w+', dtype=np.float32, shape=(num, dim))
+    vocab = np.empty(num, dtype=VOCAB_DTYPE)
+    with open(embedding_file, encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            word, _, vec = line.rstrip().partition(' ')
+            matrix[i] = np.array(vec.split(' '), dtype=np.float32)
+            vocab[i] = word_hash(normalize(word)), i
+    matrix.flush()
+    del matrix
+    vocab.sort(order=['hash', 'row'])
+    np.save(vocab_file + '.tmp', vocab)
+    # np.save added the .npy suffix
+    os.replace(vocab_file + '.tmp.npy', vocab_file)
+    os.replace(matrix_file + '.tmp', matrix_file)
+    with open(stamp_file + '.tmp', 'w') as f:
+        json.dump(stamp, f)
+    os.replace(stamp_file + '.tmp', stamp_file)
+    return num, dim
+
+
+def load(embedding_file, words):
+    """Look up the vectors of words in the converted embedding_file.
+
+    Words duplicated in the file once normalized get the average of their
+    vectors.
+    Args:
+        embedding_file: path to the text file of embeddings, converted.
+        words: list of normalized words.
+    Returns:
+        found: list of the words in the file
+        vectors: float32 matrix, the vectors of found
+    """
+    matrix_file, vocab_file, _ = store_paths(embedding_file)
+    matrix = np.load(matrix_file, mmap_mode='r')
+    vocab = np.load(vocab_file, mmap_mode='r')
+    hashes = np.fromiter((word_hash(w) for w in words), dtype=np.uint64, count=len(words))
+    start = np.searchsorted(vocab['hash'], hashes, side='left')
+    end = np.searchsorted(vocab['hash'], hashes, side='right')
+    counts = end - start
+    hit = np.nonzero(counts)[0]
+
+    # rows in file order read the memory map sequentially
+    rows = np.asarray(vocab['row'][start[hit]])
+    order = np.argsort(rows)
+    vectors = np.empty((len(hit), matrix.shape[1]), dtype=np.float32)
+    vectors[order] = matrix[rows[order]]
+    for j in np.nonzero(counts[hit] > 1)[0]:
+        i = hit[j]
+        logger.warning(f'WARN: Duplicate embedding found for {words[i].encode("utf-8")}')
+        dup_rows = np.sort(vocab['row'][start[i]: end[i]])
+        # summed in file order, as the text loader does
+        vec = np.array(matrix[dup_rows[0]])
+        for row in dup_rows[1:]:
+            vec += matrix[row]
+        vectors[j] = vec / len(dup_rows)
+    return [words[i] for i in hit], vectors
+
+
+def load_embeddings(embedding, word_dict, words, embedding_file):
+    """Copy the pretrained embeddings of words into the rows of embedding.
+
+    Reads the binary format if embedding_file was converted and has not
+    changed since, else the text.
+    Args:
+        embedding: embedding weight tensor, indexed by word_dict.
+        word_dict: dictionary of the words.
+        words: set of normalized tokens in word_dict.
+        embedding_file: path to text file of embeddings, space separated.
+    Returns:
+        number of words found
+    """
+    import torch
+
+    if is_converted(embedding_file):
+        words = sorted(words)
+        found, vectors = load(embedding_file, words)
+        assert vectors.shape[1] == embedding.size(1)
+        index = torch.LongTensor([word_dict[w] for w in found])
+        embedding[index] = torch.from_numpy(vectors).to(embedding.dtype)
+        return len(found)
+
+    # When normalized, some words are duplicated. (Average the embeddings).
+    vec_counts = {}
+    with open(embedding_file, encoding='utf-8') as f:
+        for line in f:
+            parsed = line.rstrip().split(' ')
+            assert(len(parsed) == embedding.size(1) + 1)
+            w = word_dict.normalize(parsed[0])
+            if w in words:
+                vec = torch.Tensor([float(i) for i in parsed[1:]])
+                if w not in vec_counts:
+                    vec_counts[w] = 1
+                    embedding[word_dict[w]].copy_(vec)
+                else:
+                    logging.warning(f'WARN: Duplicate embedding found for {w.encode("utf-8")}')
+                    vec_counts[w] = vec_counts[w] + 1
+                    embedding[word_dict[w]].add_(vec)
+
+    for w, c in vec_counts.items():
+        embedding[word_dict[w]].div_(c)
+    return len(vec_counts)
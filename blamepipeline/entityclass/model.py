@@ -19,6 +19,7 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
 
+from blamepipeline import embeddings
 from blamepipeline.entityclass.config import override_model_args
 from blamepipeline.entityclass.extractor import LSTMContextClassifier
 
@@ -63,33 +64,15 @@ class EntityClassifier(object):
             words: iterable of tokens. Only those that are indexed in the
               dictionary are kept.
             embedding_file: path to text file of embeddings, space separated.
+              Read from its binary form if converted with
+              script/preprocess/convert_embeddings.py.
         """
         words = {w for w in words if w in self.word_dict}
         logger.info(f'Loading pre-trained embeddings for {len(words)} words from {embedding_file}')
         embedding = self.network.embedding.weight.data
-
-        # When normalized, some words are duplicated. (Average the embeddings).
-        vec_counts = {}
-        with open(embedding_file, encoding='utf-8') as f:
-            for line in f:
-                parsed = line.rstrip().split(' ')
-                assert(len(parsed) == embedding.size(1) + 1)
-                w = self.word_dict.normalize(parsed[0])
-                if w in words:
-                    vec = torch.Tensor([float(i) for i in parsed[1:]])
-                    if w not in vec_counts:
-                        vec_counts[w] = 1
-                        embedding[self.word_dict[w]].copy_(vec)
-                    else:
-                        logging.warning(f'WARN: Duplicate embedding found for {w.encode("utf-8")}')
-                        vec_counts[w] = vec_counts[w] + 1
-                        embedding[self.word_dict[w]].add_(vec)
-
-        for w, c in vec_counts.items():
-            embedding[self.word_dict[w]].div_(c)
-
+        loaded = embeddings.load_embeddings(embedding, self.word_dict, words, embedding_file)
         logger.info('Loaded %d embeddings (%.2f%%)' %
-                    (len(vec_counts), 100 * len(vec_counts) / len(words)))
+                    (loaded, 100 * loaded / len(words)))
 
     def init_optimizer(self, state_dict=None):
         """Initialize an optimizer for the free parameters of the network.
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Blame ties of raw articles.
+
+The articles are tokenized and NER tagged, their persons and organizations
+are merged into entities and tagged in the content (as the blameextract
+prepare_data script does with all entities, merged per article), and every
+ordered pair of entities is scored by a BlameExtractor in article mode.
+
+The stages run concurrently, connected by bounded queues:
+    tokenize (thread) -> entities (thread) -> score (caller)
+so the tokenizer works on the next articles while the model scores.
+
+Models trained in article mode score each article at once; the others
+score one sample per pair, masked as in their training data.
+"""
+
+import itertools
+import queue
+import threading
+
+from blamepipeline.blameextract import vector
+from blamepipeline.preprocess.entity_extract import ner_entities, tokenize_entities
+from blamepipeline.preprocess.entity_merge import entity_merge
+from blamepipeline.preprocess.entity_tag import EntityTagger
+
+# end of the output of a stage
+_DONE = object()
+
+
+def candidate_article(content, entities):
+    """Tag the entities in content and pair them.
+
+    Args:
+        content: tokenized sentences of the article, tagged in place.
+        entities: entities (tuples of words) of the article.
+    Returns:
+        article in the format of blameextract.utils.group_articles, all
+        ordered pairs of its entities unlabeled. Its entities are the ids
+        of the merged entities found in content.
+    """
+    entities = sorted(set(entities))
+    entity2id, _ = entity_merge(entities)
+    # longer entities first, as prepare_data tags them
+    epos = EntityTagger(sorted(entities, key=lambda t: -len(t)), entity2id).tag(content)
+    ids = sorted(epos)
+    # only the sentences with mentions are encoded
+    sent_ids = sorted({si for e in ids for si, _ in epos[e]})
+    rows = {si: row for row, si in enumerate(sent_ids)}
+    return {'sents': [content[si] for si in sent_ids],
+            'entities': ids,
+            'epos': {e: [(rows[si], wi) for si, wi in epos[e]] for e in ids},
+            'pairs': list(itertools.permutations(range(len(ids)), 2))}
+
+
+def tokenize_articles(tokenizer, contents, uncased=False):
+    """Tokenize raw articles and extract their entities.
+
+    Args:
+        tokenizer: Tokenizer annotating ner.
+        contents: raw texts of the articles.
+        uncased: lowercase the words of the content and of the entities.
+    Returns:
+        (sentences, entities) of every article, entities are tuples of words
+    """
+    tokenized = tokenizer.tokenize_batch(contents)
+    names = [ner_entities(tokens) for tokens in tokenized]
+    # tokenize every distinct entity name once
+    distinct = sorted(set().union(*names))
+    entity_tokens = dict(zip(distinct, tokenize_entities(tokenizer, distinct)))
+    if uncased:
+        # entities are matched against the words of the content
+        entity_tokens = {name: tuple(w.lower() for w in entity) for name, entity in entity_tokens.items()}
+    return [(tokens.words(uncased=uncased), [entity_tokens[name] for name in article_names])
+            for tokens, article_names in zip(tokenized, names)]
+
+
+def pair_sample(candidate, src, tgt):
+    """The sample of a pair of entities of a candidate article, as the
+    blameextract prepare_data script writes them: the sentences of their
+    mentions, and the positions of the mentions in these sentences.
+    """
+    entities, epos = candidate['entities'], candidate['epos']
+    src, tgt = entities[src], entities[tgt]
+    sent_ids = sorted({si for si, _ in list(epos[src]) + list(epos[tgt])})
+    rows = {si: row for row, si in enumerate(sent_ids)}
+    return {'sents': [candidate['sents'][si] for si in sent_ids],
+            'src_pos': [(rows[si], wi) for si, wi in epos[src]],
+            'tgt_pos': [(rows[si], wi) for si, wi in epos[tgt]],
+            'src': src, 'tgt': tgt}
+
+
+def score_articles(model, candidates):
+    """Score the pairs of candidate articles in one batch.
+
+    Models trained in article mode encode each article once, with the
+    mentions of all its entities masked (unk_entity). Other models score
+    one sample per pair, only the mentions of the pair masked, like the
+    samples they were trained on.
+    Args:
+        model: BlameExtractor.
+        candidates: articles of candidate_article (or group_articles).
+    Returns:
+        ties [(source, target, score)] of every article, by decreasing score
+    """
+    scored = [c for c in candidates if c['pairs']]
+    scores = []
+    # the words are only used by elmo
+    words = model.args.pretrain_file == 'elmo'
+    if scored and getattr(model.args, 'article_mode', False):
+        exs = [vector.vectorize_article(c, model) for c in scored]
+        if not words:
+            exs = [ex[:3] + (None,) + ex[4:] for ex in exs]
+        scores = model.score(vector.batchify_articles(exs)).tolist()
+    elif scored:
+        exs = [vector.vectorize(pair_sample(c, src, tgt), model) for c in scored for src, tgt in c['pairs']]
+        # batchify takes lists for examples without labels
+        exs = [list(ex[:5]) + [ex[5] if words else None] for ex in exs]
+        scores = model.score(vector.batchify(exs)).tolist()
+    results = []
+    offset = 0
+    for c in candidates:
+        ents = c['entities']
+        ties = [(ents[src], ents[tgt], score)
+                for (src, tgt), score in zip(c['pairs'], scores[offset: offset + len(c['pairs'])])]
+        offset += len(c['pairs'])
+        results.append(sorted(ties, key=lambda t: -t[2]))
+    return results
+
+
+class BlamePipeline(object):
+    """Score the entity pairs of raw articles with a BlameExtractor."""
+
+    def __init__(self, model, tokenizer, batch_size=16, chunk_size=8,
+                 queue_size=64, uncased=False):
+        """
+        Args:
+            model: BlameExtractor, on its device.
+            tokenizer: Tokenizer annotating ner, used by one thread only.
+            batch_size: articles scored per forward of the model.
+            chunk_size: articles tokenized per tokenizer batch.
+            queue_size: articles buffered between two stages.
+            uncased: lowercase the words of the content.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.uncased = uncased
+
+    def run(self, articles):
+        """Score the articles.
+
+        Args:
+            articles: iterable of dicts with the raw text in 'content',
+                consumed by the tokenizer thread.
+        Yields:
+            (article, ties) in input order, ties [(source, target, score)]
+            of every pair of entities, by decreasing score
+        """
+        stop = threading.Event()
+        tokenized = queue.Queue(self.queue_size)
+        candidates = queue.Queue(self.queue_size)
+        threads = [
+            threading.Thread(target=self._stage, args=(self._tokenize(articles), tokenized, stop),
+                             name='tokenize', daemon=True),
+            threading.Thread(target=self._stage, args=(self._candidates(tokenized, stop), candidates, stop),
+                             name='entities', daemon=True),
+        ]
+        for t in threads:
+            t.start()
+        try:
+            batch = []
+            for item in self._drain(candidates, stop):
+                batch.append(item)
+                if sum(1 for _, c in batch if c['pairs']) >= self.batch_size:
+                    yield from self._score(batch)
+                    batch = []
+            yield from self._score(batch)
+        finally:
+            # unblock the stages if the caller stops early
+            stop.set()
+            for t in threads:
+                t.join()
+
+    def _tokenize(self, articles):
+        """Yield (article, sentences, entities) of the articles."""
+        articles = iter(articles)
+        while True:
+            chunk = list(itertools.islice(articles, self.chunk_size))
+            if not chunk:
+                break
+            tokenized = tokenize_articles(self.tokenizer, [a['content'] for a in chunk], uncased=self.uncased)
+            for article, (content, entities) in zip(chunk, tokenized):
+                yield article, content, entities
+
+    def _candidates(self, inbox, stop):
+        """Yield (article, candidate article) of the tokenized articles."""
+        for article, content, entities in self._drain(inbox, stop):
+            yield article, candidate_article(content, entities)
+
+    def _score(self, batch):
+        """Yield (article, ties) of the batch, the pairs of all articles scored at once."""
+        ties = score_articles(self.model, [c for _, c in batch])
+        for (article, _), article_ties in zip(batch, ties):
+            yield article, article_ties
+
+    @staticmethod
+    def _stage(items, outbox, stop):
+        """Put items into outbox until done or stopped, then _DONE or the error."""
+        try:
+            for item in items:
+                if not BlamePipeline._put(outbox, item, stop):
+                    return
+            item = _DONE
+        except Exception as e:
+            # raised by the caller
+            item = e
+        BlamePipeline._put(outbox, item, stop)
+
+    @staticmethod
+    def _put(outbox, item, stop):
+        while not stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _drain(inbox, stop):
+        """Yield the items of inbox up to _DONE, raise the error of the stage."""
+        while not stop.is_set():
+            try:
+                item = inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
@@ -14,6 +14,11 @@ import os
 import csv
 import re
 import datetime
+import hashlib
+import json
+import locale
+import mmap
+import multiprocessing
 import string
 
 #fix relative import statement to absolute import statement
@@ -40,67 +45,127 @@ FOX_PATTERN = r'Fox News Network\s*(?P<title>\w+ \d+, \d+ \w+).*'\
 # compile regex
 PATTERNS = {'FOX': FOX_PATTERN}
 REGEX = {source: re.compile(PATTERNS[source], re.DOTALL | re.MULTILINE) for source in PATTERNS}
+# literals every match contains, checked before running the regex
+MARKERS = {'FOX': ('Fox News Network', 'LOAD-DATE')}
 
 # June 29, 2010 Tuesday
 FOX_DATE_FORMAT = '%B %d, %Y %A'
 
 
+def read_raw_articles(filename):
+    '''
+    Yield the raw articles of a dump one at a time.
+    The file is memory-mapped and split on form feeds, so only one article
+    is decoded at a time. Line endings are normalized to \\n.
+    '''
+    encoding = locale.getpreferredencoding(False)
+    with open(filename, 'rb') as article_file:
+        try:
+            data = mmap.mmap(article_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+        with data:
+            start = 0
+            while start < len(data):
+                end = data.find(b'\f', start)
+                if end == -1:
+                    end = len(data)
+                raw_article = data[start:end].decode(encoding)
+                start = end + 1
+                raw_article = raw_article.replace('\r\n', '\n').replace('\r', '\n').strip()
+                if raw_article:
+                    yield raw_article
+
+
+def fingerprint(article):
+    '''
+    Hash of all the fields of an article, equal for equal articles.
+    '''
+    return hashlib.sha1(json.dumps(article, sort_keys=True).encode('utf-8')).digest()
+
+
 class DBReader():
     '''
     A class to read from csv file.
     Input: filename
     Output: List[{Entry}]
-    Entry: {title, date, section, source, s_title, s_category, target, t_title,
-            t_category, claim}
+    Entry: {title, date, source, target, claim}
     '''
+    FIELDS = ('title', 'date', 'source', 'target', 'claim')
 
     def __init__(self, filename, source):
         print('Reading from {}...'.format(filename))
+        self.filename = filename
         self.source = source
-        self.entries = []
-        with open(filename) as csv_file:
-            fieldnames = ['valid', 'title', 'date', 'source', 'target', 'claim']
-            reader = csv.DictReader(csv_file, fieldnames=fieldnames, dialect="excel")
+        self.entries = None
+        # rows skipped because an identical entry was read before
+        self.duplicates = 0
+
+    def iter_entries(self):
+        '''
+        Stream the valid entries of the csv file, skipping duplicates.
+        '''
+        seen = set()
+        self.duplicates = 0
+        with open(self.filename) as csv_file:
+            # columns: valid, title, date, source, target, claim
+            reader = csv.reader(csv_file, dialect="excel")
             next(reader)
             for row in reader:
-                if row['valid'] == '0':
+                # DictReader skipped blank lines too
+                if not row or row[0] == '0':
                     continue
-                r = {}
-                r['title'] = row['title'].strip().lstrip(', ')
-                r['date'] = row['date'].strip()
-                r['source'] = row['source'].strip()
-                r['target'] = row['target'].strip()
-                r['claim'] = row['claim'].strip().lstrip(string.punctuation).replace("''", '"')
-                if r not in self.entries:
-                    self.entries.append(r)
+                title, date, source, target, claim = row[1:6]
+                key = (title.strip().lstrip(', '),
+                       date.strip(),
+                       source.strip(),
+                       target.strip(),
+                       claim.strip().lstrip(string.punctuation).replace("''", '"'))
+                if key in seen:
+                    self.duplicates += 1
+                    continue
+                seen.add(key)
+                yield dict(zip(self.FIELDS, key))
 
     def get_entries(self):
         '''
         Return all the entries in the dataset.
         '''
+        if self.entries is None:
+            self.entries = list(self.iter_entries())
+            print('{} entries, {} duplicates skipped.'.format(len(self.entries), self.duplicates))
         return self.entries
 
 
 class Articles():
     '''
-    A list of news articles.
+    The news articles of a dump, read lazily.
     Input: filename
-    Output: List[{Article}]
+    Output: Iterator[{Article}]
     Article: {date, title, subtitle, author, section, length, guests, content}
     '''
 
-    def __init__(self, filename, source):
-        # read articles and match
+    def __init__(self, filename, source, seen=None):
+        '''
+        seen: set of fingerprints of articles already yielded, to skip
+              duplicates across several dumps.
+        '''
+        self.filename = filename
         self.source = source
-        self.articles = []
-        with open(filename) as article_file:
-            raw_articles = article_file.read().strip().split('\f')
-            for raw_article in raw_articles:
-                raw_article = raw_article.strip()
-                article = self.match(raw_article)
-                if article and (article['title'] or article['subtitle']):
-                    if article not in self.articles:
-                        self.articles.append(article)
+        self.seen = set() if seen is None else seen
+
+    def __iter__(self):
+        markers = MARKERS.get(self.source, ())
+        for raw_article in read_raw_articles(self.filename):
+            if not all(marker in raw_article for marker in markers):
+                continue
+            article = self.match(raw_article)
+            if article and (article['title'] or article['subtitle']):
+                key = fingerprint(article)
+                if key not in self.seen:
+                    self.seen.add(key)
+                    yield article
 
     def match(self, raw_article):
         '''
@@ -165,9 +230,9 @@ class Articles():
 
     def get_articles(self):
         '''
-        Return all the articles in the dataset.
+        Return an iterator over the articles in the dump.
         '''
-        return self.articles
+        return iter(self)
 
 
 class Dataset():
@@ -195,18 +260,35 @@ class Dataset():
 
         return entries
 
-    def get_articles(self):
+    def get_articles(self, workers=1):
         '''
-        Return articles of the dataset.
+        Return an iterator over the articles of the dataset.
+        Duplicates are skipped across files. With workers > 1 the files are
+        parsed in a process pool; articles come in the same order either way.
         '''
-        article_data = []
-        for filename in self.files:
-            if filename.endswith('.txt'):
-                article_data += Articles(
-                    os.path.join(self.dirname, filename),
-                    self.source).get_articles()
-
-        return article_data
+        filenames = [os.path.join(self.dirname, filename)
+                     for filename in self.files if filename.endswith('.txt')]
+        seen = set()
+        if workers <= 1:
+            for filename in filenames:
+                yield from Articles(filename, self.source, seen).get_articles()
+            return
+        with multiprocessing.Pool(workers) as pool:
+            tasks = [(filename, self.source) for filename in filenames]
+            for articles in pool.imap(_parse_file, tasks):
+                for key, article in articles:
+                    if key not in seen:
+                        seen.add(key)
+                        yield article
+
+
+def _parse_file(task):
+    '''
+    Parse one dump in a worker. Returns its unique articles with their fingerprints.
+    '''
+    filename, source = task
+    articles = Articles(filename, source)
+    return [(fingerprint(article), article) for article in articles]
 
 
 def main():
@@ -220,8 +302,8 @@ def main():
         print('\n{}:'.format(datasetname))
         dataset = Dataset(datasetname)
         entries = dataset.get_entries()
-        articles = dataset.get_articles()
-        print('{} articles. {} entries.'.format(len(articles), len(entries)))
+        num_articles = sum(1 for _ in dataset.get_articles())
+        print('{} articles. {} entries.'.format(num_articles, len(entries)))
 
 
 if __name__ == '__main__':
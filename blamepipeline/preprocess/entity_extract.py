@@ -0,0 +1,45 @@
+# encoding: utf-8
+
+'''
+Extract the entities of tokenized articles and tokenize entity names.
+'''
+
+# NER tags of the entities that can be blamed
+ENTITY_TAGS = {'ORGANIZATION', 'PERSON'}
+
+
+def ner_entities(tokens):
+    '''
+    Names of the persons and organizations found by NER, of 2 characters or more.
+    tokens: Tokens annotated with ner
+    '''
+    return {name for name, tag in tokens.entity_groups()
+            if tag in ENTITY_TAGS and len(name) >= 2}
+
+
+def tokenize_entity(tokenizer, entity):
+    '''
+    Tokenize and clean the entity.
+    entitt: str
+    '''
+    return clean_entity(tokenizer.tokenize(entity))
+
+
+def tokenize_entities(tokenizer, entities, chunksize=64):
+    '''
+    Tokenize and clean a list of entities, chunksize entities per request.
+    entities: list of str
+    '''
+    for tokens in tokenizer.imap(entities, chunksize=chunksize):
+        yield clean_entity(tokens)
+
+
+def clean_entity(tokens):
+    '''
+    Flatten and clean a tokenized entity.
+    tokens: Tokens
+    '''
+    entity = tuple(t for s in tokens.words() for t in s)
+    entity = entity[:-1] if entity[-1] == '.' else entity
+    entity = entity[1:] if entity[0] == '--' else entity
+    return entity
@@ -0,0 +1,109 @@
+# encoding: utf-8
+
+'''
+Merge the aliases of entities into one entity id.
+
+An entity (tuple of words) is an alias of another if its name occurs in the
+other's name, e.g. ('Obama',) in ('Barack', 'Obama'), or if the other adds
+a middle initial, e.g. ('George', 'Bush') and ('George', 'W.', 'Bush').
+Aliases are followed to an entity that is not an alias of anything, whose
+name is the id.
+'''
+
+from collections import defaultdict
+
+# length of the character grams indexing entity names
+GRAM = 3
+
+
+def name(entity):
+    return ' '.join(entity)
+
+
+class EntityIndex():
+    '''
+    Find the entities an entity is an alias of, without comparing it to
+    every other entity.
+    '''
+
+    def __init__(self, entities):
+        # Only names of several words contain other entities.
+        self.entities = [e for e in entities if len(e) > 1]
+        self.names = [name(e) for e in self.entities]
+        # gram length -> {character gram -> entities whose name has it}
+        self.grams = {GRAM: self.index_grams(GRAM)}
+        # (first word, last word) -> entities with a middle initial
+        self.middles = defaultdict(list)
+        for e in self.entities:
+            if len(e) == 3 and e[1].endswith('.'):
+                self.middles[e[0], e[-1]].append(e)
+
+    def index_grams(self, size):
+        grams = defaultdict(list)
+        for i, n in enumerate(self.names):
+            for g in {n[j: j + size] for j in range(len(n) - size + 1)}:
+                grams[g].append(i)
+        return grams
+
+    def containers(self, entity):
+        '''
+        Return: entities of several words whose name contains entity's name.
+        '''
+        n = name(entity)
+        size = min(len(n), GRAM)
+        if size not in self.grams:
+            # shorter grams are only needed for the few very short names
+            self.grams[size] = self.index_grams(size)
+        # every container has all grams of n, check the rarest one's list
+        grams = [self.grams[size].get(n[j: j + size], ()) for j in range(len(n) - size + 1)]
+        candidates = min(grams, key=len)
+        return [self.entities[i] for i in candidates
+                if n in self.names[i] and self.entities[i] != entity]
+
+    def parent(self, entity):
+        '''
+        Return: the entity that entity is directly an alias of, or None.
+        The longest one if there are several.
+        '''
+        candidates = self.containers(entity)
+        if len(entity) == 2:
+            # middle name
+            candidates += self.middles.get((entity[0], entity[-1]), [])
+        if not candidates:
+            return None
+        return max(candidates, key=lambda e: (len(name(e)), e))
+
+
+def entity_merge(entities):
+    '''
+    Merge aliases of entities.
+    entities: iterable of entity names (tuples)
+    Return: entity2id {entity -> id (str)},
+            entity2alias {id entity (tuple) -> aliases sorted by word length in decrease order}
+    '''
+    entities = set(entities)
+    index = EntityIndex(entities)
+    parent = {}
+    for e in entities:
+        p = index.parent(e)
+        if p is not None:
+            parent[e] = p
+
+    # follow aliases to the root, pointing every entity on the way at it
+    root = {}
+    for e in entities:
+        path = []
+        while e not in root and e in parent:
+            path.append(e)
+            e = parent[e]
+        r = root.get(e, e)
+        root[e] = r
+        for a in path:
+            root[a] = r
+
+    entity2id = {e: name(r) for e, r in root.items()}
+    entity2alias = defaultdict(set)
+    for e, r in root.items():
+        entity2alias[r].add(e)
+    entity2alias = {e: sorted(sorted(alias), key=lambda t: -len(t)) for e, alias in entity2alias.items()}
+    return entity2id, entity2alias
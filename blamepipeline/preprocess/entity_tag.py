@@ -0,0 +1,75 @@
+# encoding: utf-8
+
+'''
+Replace the entities in tokenized article content by their ids.
+'''
+
+from collections import defaultdict
+
+# key of the entity index stored in the trie node where an entity ends
+END = None
+
+
+class EntityTagger():
+    '''
+    Token trie of the entities of an article. An entity matches its words,
+    or its words with a period after the last one (end of sentence).
+    At every position the longest entity wins; of entities of the same
+    length, the first in entities.
+    '''
+
+    def __init__(self, entities, entity2id):
+        '''
+        entities: [entity (tuple)], in order of preference
+        entity2id: {entity -> id (str)}
+        '''
+        self.ids = [entity2id[e] for e in entities]
+        self.id_set = set(self.ids)
+        self.root = {}
+        for i, e in enumerate(entities):
+            if not e:
+                continue
+            node = self.root
+            for w in e[:-1]:
+                node = node.setdefault(w, {})
+            for last in (e[-1], e[-1] + '.'):
+                node.setdefault(last, {}).setdefault(END, i)
+
+    def match(self, s, start):
+        '''
+        Return: (entity index, length) of the longest entity at s[start:],
+                or (None, 0).
+        '''
+        node, found, length = self.root, None, 0
+        for j in range(start, len(s)):
+            node = node.get(s[j])
+            if node is None:
+                break
+            if END in node:
+                found, length = node[END], j - start + 1
+        return found, length
+
+    def tag(self, content):
+        '''
+        Merge the words of every entity in content into a single token, its id.
+        content: [[word]], sentences are replaced in place
+        Return: epos {id -> [(sentence index, word index)]} of the ids in
+                the tagged content
+        '''
+        epos = defaultdict(list)
+        for si, s in enumerate(content):
+            tagged = []
+            wi = 0
+            while wi < len(s):
+                found, length = self.match(s, wi)
+                if found is None:
+                    w = s[wi]
+                    wi += 1
+                else:
+                    w = self.ids[found]
+                    wi += length
+                if w in self.id_set:
+                    epos[w].append((si, len(tagged)))
+                tagged.append(w)
+            content[si] = tagged
+        return epos
@@ -6,52 +6,125 @@ Match articles with annotated data
 
 from collections import defaultdict
 import argparse
+import bisect
 
 from blamepipeline.preprocess.dataloader import Dataset
 
 case1, case2 = 0, 0
 
-
-def match_data(source):
-    dataset = Dataset(source)
-    articles = dataset.get_articles()
-    entries = dataset.get_entries()
-
+# entry titles shorter than this never match
+MIN_TITLE_LEN = 10
+
+# match reasons
+TITLE_EXACT = 'title_exact'
+TITLE_SUBSTRING = 'title_substring'
+SUBTITLE_EXACT = 'subtitle_exact'
+SUBTITLE_SUBSTRING = 'subtitle_substring'
+
+
+class ArticleIndex():
+    '''
+    Index of the articles of one date for matching entry titles.
+    An entry matches an article if its title equals or occurs in the
+    article's title or subtitle.
+    '''
+    # never occurs in titles, so no match spans two of them
+    SEP = '\0'
+
+    def __init__(self, articles):
+        self.articles = articles
+        # titles and subtitles in the order they are checked, in one buffer
+        fields = []
+        self.starts = []
+        offset = 0
+        for article in articles:
+            for field in (article['title'], article['subtitle']):
+                field = field or ''
+                fields.append(field)
+                self.starts.append(offset)
+                offset += len(field) + len(self.SEP)
+        self.fields = fields
+        self.text = self.SEP.join(fields)
+
+    def match(self, title, all_matches=False):
+        '''
+        Return: [(article index, reason)] of the articles matching an entry
+                title, in order. Only the first one unless all_matches.
+        '''
+        if not title or len(title) < MIN_TITLE_LEN or self.SEP in title:
+            return []
+        matches = []
+        pos = self.text.find(title)
+        while pos >= 0:
+            k = bisect.bisect_right(self.starts, pos) - 1
+            i, is_subtitle = divmod(k, 2)
+            if is_subtitle:
+                reason = SUBTITLE_EXACT if self.fields[k] == title else SUBTITLE_SUBSTRING
+            else:
+                reason = TITLE_EXACT if self.fields[k] == title else TITLE_SUBSTRING
+            if not matches or matches[-1][0] != i:
+                matches.append((i, reason))
+            if not all_matches:
+                break
+            # continue after this field, an article is listed once per field
+            pos = self.text.find(title, self.starts[k] + len(self.fields[k]) + 1)
+        return matches
+
+
+def match_entries(entries, articles, all_matches=False):
+    '''
+    Match entries with articles of the same source and date.
+    entries: [{Entry}], articles: [{Article}]. Entries and articles carry a
+    'source_name' field when they come from several sources.
+    Return: [(entry, article, reason)]. The first matching article of each
+            entry, or every match if all_matches.
+    '''
     date_articles = defaultdict(list)
     for article in articles:
-        date_articles[article['date']].append(article)
-    print('{} dates of {} articles loaded.'.format(len(date_articles), len(articles)))
-    print('{} entries loaded.'.format(len(entries)))
-
-    title_match = 0
-    subtitle_match = 0
-
-    pairs = []
-
-    def matches(entry_title, article_title):
-        if not entry_title or len(entry_title) < 10:
-            return False
-        elif entry_title and article_title and entry_title == article_title:
-            return True
-        elif entry_title and entry_title in article_title:
-            return True
-        return False
+        date_articles[article.get('source_name'), article['date']].append(article)
 
+    matched = []
+    indexes = {}
     for entry in entries:
-        for article in date_articles[entry['date']]:
-            if matches(entry['title'], article['title']):
-                title_match += 1
-                pairs.append((entry, article))
-                break
-            elif matches(entry['title'], article['subtitle']):
-                subtitle_match += 1
-                pairs.append((entry, article))
-                break
+        key = entry.get('source_name'), entry['date']
+        if key not in date_articles:
+            continue
+        if key not in indexes:
+            indexes[key] = ArticleIndex(date_articles[key])
+        index = indexes[key]
+        for i, reason in index.match(entry['title'], all_matches=all_matches):
+            matched.append((entry, index.articles[i], reason))
+    return matched
+
+
+def match_data(source, workers=1, all_matches=False):
+    '''
+    source: name of a source, or a list of them.
+    '''
+    sources = [source] if isinstance(source, str) else source
+    articles, entries = [], []
+    for name in sources:
+        dataset = Dataset(name)
+        for article in dataset.get_articles(workers=workers):
+            if len(sources) > 1:
+                article = dict(article, source_name=name)
+            articles.append(article)
+        for entry in dataset.get_entries():
+            if len(sources) > 1:
+                entry = dict(entry, source_name=name)
+            entries.append(entry)
+    dates = {(article.get('source_name'), article['date']) for article in articles}
+    print('{} dates of {} articles loaded.'.format(len(dates), len(articles)))
+    print('{} entries loaded.'.format(len(entries)))
 
-    print('title match:', title_match)
-    print('subtitle match:', subtitle_match)
+    matches = match_entries(entries, articles, all_matches=all_matches)
+    reasons = defaultdict(int)
+    for _, _, reason in matches:
+        reasons[reason] += 1
+    print('title match:', reasons[TITLE_EXACT] + reasons[TITLE_SUBSTRING])
+    print('subtitle match:', reasons[SUBTITLE_EXACT] + reasons[SUBTITLE_SUBSTRING])
 
-    return pairs
+    return [(entry, article) for entry, article, _ in matches]
 
 
 def main(args):
@@ -61,7 +134,7 @@ def main(args):
         sources = [args.source.upper()]
     for source in sources:
         print(source)
-        pairs = match_data(source)
+        pairs = match_data(source, workers=args.workers)
         print('matched pairs:', len(pairs))
         print('---')
     global case1, case2
@@ -71,5 +144,7 @@ def main(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='match articles and entries')
     parser.add_argument('--source', type=str, choices=['all', 'fox'], default='all')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing the article dumps')
     args = parser.parse_args()
     main(args)
@@ -14,16 +14,29 @@ sources = ['FOX']
 cases = defaultdict(int)
 
 
+def contains(found, s, content):
+    '''
+    s in content, remembered in found (the results for this content).
+    '''
+    if s not in found:
+        found[s] = s in content
+    return found[s]
+
+
 def filter_data(pairs, source=None, ignore_claim=False):
     valid_pairs = []
     articles = set()
     global cases
+    # Pairs of the same article share its containment results, so the
+    # content is scanned once per distinct string, not once per blame tie.
+    article_found = {}
 
     for entry, article in pairs:
         source = entry['source']
         target = entry['target']
         claim = entry['claim']
         content = article['content']
+        found = article_found.setdefault(content, {})
 
         if not source or not target:
             # empty entity
@@ -41,10 +54,10 @@ def filter_data(pairs, source=None, ignore_claim=False):
             # source and target is the same
             cases['same src and tgt'] += 1
             continue
-        if source not in content:
+        if not contains(found, source, content):
             cases['src not in content'] += 1
             continue
-        if target not in content:
+        if not contains(found, target, content):
             cases['tgt not in content'] += 1
             continue
         if not ignore_claim:
@@ -58,7 +71,7 @@ def filter_data(pairs, source=None, ignore_claim=False):
             if target not in claim:
                 cases['tgt not in claim'] += 1
                 continue
-            if claim not in content:
+            if not contains(found, claim, content):
                 cases['claim not in content'] += 1
                 continue
         d = {}
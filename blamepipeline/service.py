@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""HTTP service scoring blame ties with a BlameExtractor loaded once.
+
+Endpoints (JSON bodies):
+    POST /score/article  {"content": raw text}
+        -> {"ties": [{"source", "target", "score"}]} of every entity pair
+    POST /score/pairs    {"sents": [[word]], "epos": {entity: [[sentence, word]]},
+                          "pairs": [[source, target]]}
+        tokenized sentences where every entity mention is a single word
+        (as in the samples files), -> {"scores": [score of every pair]}
+    GET  /metrics        latency and batch size histograms
+    GET  /health
+
+Concurrent requests are coalesced into micro-batches: a batch is scored
+when it has max_batch_size requests or its first request waited max_wait
+seconds. Articles are tokenized in micro-batches the same way. The model
+and the tokenizer each run in a single thread, off the event loop.
+"""
+
+import asyncio
+import bisect
+import concurrent.futures
+import http
+import json
+import logging
+import time
+
+from blamepipeline.pipeline import candidate_article, score_articles, tokenize_articles
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]
+
+
+class Histogram(object):
+    """Counts of observations in buckets of upper bounds, the last one unbounded."""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket of the q quantile (inf if above the bounds)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        buckets = [[bound, count] for bound, count in zip(self.bounds, self.counts)]
+        buckets.append(['+Inf', self.counts[-1]])
+        return {'buckets': buckets,
+                'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent calls into batches of a function run in one thread."""
+
+    def __init__(self, func, max_batch_size=32, max_wait=0.01):
+        """
+        Args:
+            func: list of items -> list of their results, run in a worker thread.
+            max_batch_size: most items of a batch.
+            max_wait: seconds the first item of a batch waits for others.
+        """
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_sizes = Histogram([2 ** i for i in range(max_batch_size.bit_length())])
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+
+    async def submit(self, item):
+        """Return: the result of item, once its batch ran."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def run(self):
+        """Run the batches until cancelled."""
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # callers that gave up are not computed
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            self.batch_sizes.observe(len(batch))
+            outcomes = await self._run([item for item, _ in batch])
+            for (_, future), (result, error) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    async def _run(self, items):
+        """Return: (result, error) of every item. The items of a failed batch
+        are run one by one, so that a bad item only fails its own call.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.func, items)
+            return [(result, None) for result in results]
+        except Exception as e:
+            if len(items) == 1:
+                logger.exception('Item failed')
+                return [(None, e)]
+            logger.exception(f'Batch of {len(items)} failed, running its items one by one')
+        outcomes = []
+        for item in items:
+            outcomes += await self._run([item])
+        return outcomes
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _is_position(position, sents):
+    """Whether position is a [sentence, word] index of a word of sents."""
+    if not isinstance(position, list) or len(position) != 2:
+        return False
+    si, wi = position
+    # bool is an int, and negative indexes would be accepted by sents
+    if type(si) is not int or type(wi) is not int:
+        return False
+    return 0 <= si < len(sents) and 0 <= wi < len(sents[si])
+
+
+class BlameService(object):
+    """Score articles and entity pairs over HTTP."""
+
+    def __init__(self, model, tokenizer=None, max_batch_size=32, max_wait=0.01, uncased=False):
+        """
+        Args:
+            model: BlameExtractor, on its device.
+            tokenizer: Tokenizer annotating ner, None to serve pairs only.
+            max_batch_size: most requests scored (or tokenized) at once.
+            max_wait: seconds a request waits for others to batch with.
+            uncased: lowercase the words of the articles.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.uncased = uncased
+        self.scorer = MicroBatcher(lambda candidates: score_articles(model, candidates),
+                                   max_batch_size=max_batch_size, max_wait=max_wait)
+        self.article_tokenizer = MicroBatcher(self._candidates, max_batch_size=max_batch_size, max_wait=max_wait)
+        self.latency = {'article': Histogram(LATENCY_BOUNDS), 'pairs': Histogram(LATENCY_BOUNDS)}
+        self.routes = {
+            ('POST', '/score/article'): self.score_article,
+            ('POST', '/score/pairs'): self.score_pairs,
+            ('GET', '/metrics'): self.metrics,
+            ('GET', '/health'): self.health,
+        }
+        self.tasks = []
+
+    def _candidates(self, contents):
+        return [candidate_article(content, entities)
+                for content, entities in tokenize_articles(self.tokenizer, contents, uncased=self.uncased)]
+
+    # --------------------------------------------------------------------------
+    # Handlers
+    # --------------------------------------------------------------------------
+
+    async def score_article(self, request):
+        if self.tokenizer is None:
+            raise BadRequest('No tokenizer: only /score/pairs is served')
+        content = request.get('content')
+        if not isinstance(content, str):
+            raise BadRequest('content: raw text of the article expected')
+        candidate = await self.article_tokenizer.submit(content)
+        ties = await self.scorer.submit(candidate)
+        return {'ties': [{'source': src, 'target': tgt, 'score': score} for src, tgt, score in ties]}
+
+    async def score_pairs(self, request):
+        sents, epos, pairs = request.get('sents'), request.get('epos'), request.get('pairs')
+        # checked before batching, a bad request must not reach the model
+        if not isinstance(sents, list) or not all(
+                isinstance(s, list) and all(isinstance(w, str) for w in s) for s in sents):
+            raise BadRequest('sents: list of sentences (lists of words) expected')
+        if not isinstance(epos, dict):
+            raise BadRequest('epos: object of entity -> [[sentence, word]] expected')
+        for e, positions in epos.items():
+            if not isinstance(positions, list) or not positions:
+                raise BadRequest(f'epos: {e} has no mention')
+            for position in positions:
+                if not _is_position(position, sents):
+                    raise BadRequest(f'epos: {e} has an invalid position {position!r}')
+                si, wi = position
+                if sents[si][wi] != e:
+                    raise BadRequest(f'epos: {e} is not at its position {position!r} in sents')
+        if not isinstance(pairs, list) or not all(
+                isinstance(p, list) and len(p) == 2 and all(isinstance(e, str) for e in p) for p in pairs):
+            raise BadRequest('pairs: list of [source, target] expected')
+        entities = sorted(epos)
+        index = {e: i for i, e in enumerate(entities)}
+        unknown = [e for p in pairs for e in p if e not in index]
+        if unknown:
+            raise BadRequest(f'pairs: {unknown[0]} is not in epos')
+        pairs = [(index[src], index[tgt]) for src, tgt in pairs]
+        if not pairs:
+            return {'scores': []}
+        candidate = {'sents': sents, 'entities': entities, 'epos': epos, 'pairs': pairs}
+        ties = await self.scorer.submit(candidate)
+        # ties are sorted by score, put them back in request order
+        scores = {(src, tgt): score for src, tgt, score in ties}
+        return {'scores': [scores[entities[src], entities[tgt]] for src, tgt in pairs]}
+
+    async def metrics(self, request):
+        return {'latency': {name: h.snapshot() for name, h in self.latency.items()},
+                'batch_size': {'score': self.scorer.batch_sizes.snapshot(),
+                               'tokenize': self.article_tokenizer.batch_sizes.snapshot()}}
+
+    async def health(self, request):
+        return {'status': 'ok'}
+
+    # --------------------------------------------------------------------------
+    # HTTP
+    # --------------------------------------------------------------------------
+
+    async def dispatch(self, method, path, body):
+        """Return: status and JSON payload of a request."""
+        handler = self.routes.get((method, path.split('?')[0]))
+        if handler is None:
+            return http.HTTPStatus.NOT_FOUND, {'error': f'No route {method} {path}'}
+        start = time.perf_counter()
+        try:
+            request = json.loads(body) if body else {}
+        except ValueError as e:
+            return http.HTTPStatus.BAD_REQUEST, {'error': f'Invalid JSON: {e}'}
+        if not isinstance(request, dict):
+            return http.HTTPStatus.BAD_REQUEST, {'error': 'JSON object expected'}
+        try:
+            payload = await handler(request)
+        except BadRequest as e:
+            return http.HTTPStatus.BAD_REQUEST, {'error': str(e)}
+        except Exception as e:
+            logger.exception(f'{method} {path} failed')
+            return http.HTTPStatus.INTERNAL_SERVER_ERROR, {'error': repr(e)}
+        name = path.rsplit('/', 1)[-1]
+        if name in self.latency:
+            self.latency[name].observe(time.perf_counter() - start)
+        return http.HTTPStatus.OK, payload
+
+    async def handle(self, reader, writer):
+        """Serve the requests of a connection, kept alive (HTTP/1.1)."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self.dispatch(method, path, body)
+                data = json.dumps(payload).encode('utf-8')
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write((f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                              f'Content-Type: application/json\r\n'
+                              f'Content-Length: {len(data)}\r\n'
+                              f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n').encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # client gone or malformed request
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """Serve until cancelled."""
+        self.tasks = [asyncio.ensure_future(self.scorer.run()), asyncio.ensure_future(self.article_tokenizer.run())]
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f'Serving on {", ".join(str(s.getsockname()) for s in server.sockets)}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.scorer.shutdown()
+            self.article_tokenizer.shutdown()
@@ -5,18 +5,12 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import importlib
 import os
-import blamepipeline
-import spacy
-from blamepipeline import tokenizers
-
-try:
-    from spacy.spacy_tokenizer import SpacyTokenizer
-except ImportError:
-    pass
 
 DEFAULTS = {
-
+    'corenlp_classpath': os.getenv('CLASSPATH'),
+    'corenlp_url': os.getenv('CORENLP_URL'),
 }
 
 
@@ -25,17 +19,32 @@ def set_default(key, value):
     DEFAULTS[key] = value
 
 
-from blamepipeline.tokenizers.corenlp_tokenizer import CoreNLPTokenizer
-
-# Spacy is optional
+# Backends are imported on first use, so importing the package doesn't pull
+# in pexpect or spacy (which is optional).
+_CLASSES = {
+    'CoreNLPTokenizer': 'blamepipeline.tokenizers.corenlp_tokenizer',
+    'CoreNLPServerTokenizer': 'blamepipeline.tokenizers.corenlp_server_tokenizer',
+    'SpacyTokenizer': 'blamepipeline.tokenizers.spacy_tokenizer',
+    'TokenizerPool': 'blamepipeline.tokenizers.tokenizer_pool',
+    'CachedTokenizer': 'blamepipeline.tokenizers.cached_tokenizer',
+    'Tokenizer': 'blamepipeline.tokenizers.tokenizer',
+    'Tokens': 'blamepipeline.tokenizers.tokenizer',
+}
 
+_REGISTRY = {
+    'spacy': 'SpacyTokenizer',
+    'corenlp': 'CoreNLPTokenizer',
+    'corenlp_server': 'CoreNLPServerTokenizer',
+}
 
 
-def get_class(name):
-    if name == 'spacy':
-        return SpacyTokenizer
-    if name == 'corenlp':
-        return CoreNLPTokenizer
+def __getattr__(name):
+    if name in _CLASSES:
+        return getattr(importlib.import_module(_CLASSES[name]), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
-    raise RuntimeError('Invalid tokenizer: %s' % name)
 
+def get_class(name):
+    if name not in _REGISTRY:
+        raise RuntimeError('Invalid tokenizer: %s' % name)
+    return __getattr__(_REGISTRY[name])
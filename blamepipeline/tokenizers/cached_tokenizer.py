@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Persistent tokenization cache.
+
+Wraps any tokenizer and stores the Tokens it returns in a single sqlite file,
+keyed by a hash of the text, the annotators and the tokenizer options. The
+least recently used entries are evicted once the file exceeds its size bound.
+"""
+
+import hashlib
+import itertools
+import json
+import pickle
+import sqlite3
+import threading
+
+from blamepipeline.tokenizers.tokenizer import Tokenizer
+
+
+class CachedTokenizer(Tokenizer):
+    # Bump when the pickled Tokens layout changes to invalidate old entries.
+    VERSION = 2
+    # Texts looked up together before the misses go to the inner tokenizer.
+    WINDOW = 1024
+    # Writes between two commits.
+    COMMIT_EVERY = 256
+
+    def __init__(self, tokenizer, path, max_size=1 << 30, options=None):
+        """
+        Args:
+            tokenizer: Tokenizer instance to cache
+            path: sqlite file of the cache
+            max_size: Bound in bytes on the stored Tokens
+            options: Tokenizer options that change its output, as given by
+              the output_options of its class
+        """
+        self.tokenizer = tokenizer
+        self.annotators = tokenizer.annotators
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        name = getattr(tokenizer, 'tokenizer_class', type(tokenizer)).__name__
+        self.signature = json.dumps([self.VERSION, name, sorted(self.annotators),
+                                     options or {}], sort_keys=True)
+
+        self._lock = threading.RLock()
+        self._writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS tokens '
+                        '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, used INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tokens_used ON tokens (used)')
+        self.size, last_used = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM tokens').fetchone()
+        self._clock = itertools.count(last_used + 1)
+
+    def _key(self, text):
+        return hashlib.sha1((self.signature + '\0' + text).encode('utf-8')).hexdigest()
+
+    def _get(self, text):
+        key = self._key(text)
+        with self._lock:
+            row = self.db.execute('SELECT value FROM tokens WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute('UPDATE tokens SET used = ? WHERE key = ?', (next(self._clock), key))
+            self._wrote()
+        return pickle.loads(row[0])
+
+    def _put(self, text, tokens):
+        value = pickle.dumps(tokens, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            cursor = self.db.execute('INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?)',
+                                     (self._key(text), value, len(value), next(self._clock)))
+            if cursor.rowcount == 1:
+                self.size += len(value)
+            self._evict()
+            self._wrote()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits max_size."""
+        while self.size > self.max_size:
+            rows = self.db.execute('SELECT key, size FROM tokens ORDER BY used LIMIT 64').fetchall()
+            if not rows:
+                self.size = 0
+                break
+            for key, size in rows:
+                self.db.execute('DELETE FROM tokens WHERE key = ?', (key,))
+                self.size -= size
+                if self.size <= self.max_size:
+                    break
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes >= self.COMMIT_EVERY:
+            self.flush()
+
+    def flush(self):
+        """Commit pending writes to disk."""
+        with self._lock:
+            self.db.commit()
+            self._writes = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM tokens').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'entries': entries, 'size': self.size}
+
+    def tokenize(self, text):
+        tokens = self._get(text)
+        if tokens is None:
+            tokens = self.tokenizer.tokenize(text)
+            self._put(text, tokens)
+        return tokens
+
+    def _lookup(self, texts):
+        """Return the cached Tokens of texts (None for misses) and the misses."""
+        found = {}
+        for text in texts:
+            if text not in found:
+                found[text] = self._get(text)
+            else:
+                # repeated text, served without tokenizing it again
+                self.hits += 1
+        return found, [text for text, tokens in found.items() if tokens is None]
+
+    def tokenize_batch(self, texts):
+        found, missing = self._lookup(texts)
+        if missing:
+            for text, tokens in zip(missing, self.tokenizer.tokenize_batch(missing)):
+                self._put(text, tokens)
+                found[text] = tokens
+        return [found[text] for text in texts]
+
+    def imap(self, texts, chunksize=1):
+        """Serve cached texts directly and stream the misses through the
+        wrapped tokenizer's imap, yielding Tokens in input order.
+        """
+        texts = iter(texts)
+        while True:
+            window = list(itertools.islice(texts, self.WINDOW))
+            if not window:
+                break
+            found, missing = self._lookup(window)
+            for text, tokens in zip(missing, self.tokenizer.imap(missing, chunksize)):
+                self._put(text, tokens)
+                found[text] = tokens
+            for text in window:
+                yield found[text]
+
+    def reset(self):
+        self.tokenizer.reset()
+
+    def shutdown(self):
+        if getattr(self, 'db', None) is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+            self.tokenizer.shutdown()
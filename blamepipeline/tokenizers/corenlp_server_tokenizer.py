@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Client for a Stanford CoreNLP server.
+
+Talks to a running StanfordCoreNLPServer (or launches one locally) over a
+pool of keep-alive HTTP connections, so several documents can be annotated
+at the same time. Requires java 8 when the server is launched locally.
+"""
+
+import collections
+import copy
+import http.client
+import itertools
+import json
+import queue
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlparse
+
+from blamepipeline.tokenizers import DEFAULTS
+from blamepipeline.tokenizers.tokenizer import Tokenizer
+from blamepipeline.tokenizers.corenlp_tokenizer import (
+    DOC_SEPARATOR, decode_output, join_documents, split_output, tokens_from_columns)
+
+
+class CoreNLPServerTokenizer(Tokenizer):
+
+    def __init__(self, **kwargs):
+        """
+        Args:
+            url: Address of a running CoreNLP server. If not given, a server
+              is launched locally on `port`.
+            classpath: Path to the corenlp directory of jars
+            mem: Java heap memory
+            port: Port of the locally launched server
+            pool_size: Number of pooled connections (documents in flight)
+            timeout: Seconds to wait for a single document
+            max_batch_chars: Bound on the characters sent in one batched request
+        """
+        self.annotators = copy.deepcopy(kwargs.get('annotators', set()))
+        self.mem = kwargs.get('mem', '2g')
+        self.pool_size = kwargs.get('pool_size', 8)
+        self.timeout = kwargs.get('timeout', 60)
+        self.max_batch_chars = kwargs.get('max_batch_chars', 50000)
+        self.server = None
+
+        url = kwargs.get('url') or DEFAULTS.get('corenlp_url')
+        if not url:
+            self.classpath = (kwargs.get('classpath') or
+                              DEFAULTS['corenlp_classpath'])
+            url = 'http://localhost:%d' % kwargs.get('port', 9000)
+            self._launch(urlparse(url).port)
+        url = urlparse(url)
+        self.host, self.port = url.hostname, url.port or 80
+
+        annotators = ['tokenize', 'ssplit']
+        if 'ner' in self.annotators:
+            annotators.extend(['pos', 'lemma', 'ner'])
+        properties = {
+            'annotators': ','.join(annotators),
+            'tokenize.options': ','.join(['untokenizable=noneDelete',
+                                          'invertible=true',
+                                          'splitHyphenated=true']),
+            'outputFormat': 'json',
+            'prettyPrint': 'false',
+        }
+        self.path = '/?' + urlencode({'properties': json.dumps(properties)})
+        properties['ssplit.boundariesToDiscard'] = DOC_SEPARATOR
+        self.batch_path = '/?' + urlencode({'properties': json.dumps(properties)})
+
+        # Idle keep-alive connections. New ones are opened on demand, and the
+        # semaphore caps how many requests are in flight at once.
+        self._connections = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._executor = None
+
+    @classmethod
+    def output_options(cls, options):
+        url = options.get('url') or DEFAULTS.get('corenlp_url')
+        # a running server's version is not known here
+        classpath = None if url else options.get('classpath') or DEFAULTS['corenlp_classpath']
+        return {'classpath': classpath, 'max_batch_chars': options.get('max_batch_chars', 50000)}
+
+    def _launch(self, port):
+        """Start a CoreNLP server and wait until it is ready."""
+        annotators = ['tokenize', 'ssplit']
+        if 'ner' in self.annotators:
+            annotators.extend(['pos', 'lemma', 'ner'])
+        cmd = ['java', '-mx' + self.mem, '-cp', self.classpath,
+               'edu.stanford.nlp.pipeline.StanfordCoreNLPServer',
+               '-port', str(port), '-timeout', str(self.timeout * 1000),
+               '-preload', ','.join(annotators), '-quiet']
+        self.server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + 120
+        while time.time() < deadline:
+            if self.server.poll() is not None:
+                raise RuntimeError('CoreNLP server exited with code %d' %
+                                   self.server.returncode)
+            try:
+                conn = http.client.HTTPConnection('localhost', port, timeout=5)
+                conn.request('GET', '/ready')
+                ready = conn.getresponse().status == 200
+                conn.close()
+                if ready:
+                    return
+            except (OSError, http.client.HTTPException):
+                pass
+            time.sleep(0.5)
+        self.shutdown()
+        raise RuntimeError('CoreNLP server did not start on port %d' % port)
+
+    def _post(self, body, path=None):
+        """Send one request on a pooled connection, return the raw reply."""
+        with self._slots:
+            try:
+                conn = self._connections.get_nowait()
+            except queue.Empty:
+                conn = http.client.HTTPConnection(self.host, self.port,
+                                                  timeout=self.timeout)
+            # A keep-alive connection may have been dropped by the server
+            # while idle. Retry once on a fresh connection.
+            for attempt in range(2):
+                try:
+                    conn.request('POST', path or self.path, body=body,
+                                 headers={'Connection': 'keep-alive'})
+                    response = conn.getresponse()
+                    output = response.read()
+                    break
+                except (socket.timeout, ConnectionError,
+                        http.client.HTTPException):
+                    conn.close()
+                    if attempt:
+                        raise
+                    conn = http.client.HTTPConnection(self.host, self.port,
+                                                      timeout=self.timeout)
+            if response.status != 200:
+                conn.close()
+                raise RuntimeError('CoreNLP server error %d: %s' %
+                                   (response.status, output[:200]))
+            self._connections.put(conn)
+        return output
+
+    def tokenize(self, text):
+        # Same cleanup as the shell tokenizer, so both see identical input.
+        clean_text = text.replace('\n', ' ')
+        columns = decode_output(self._post(clean_text.encode('utf-8')).decode('utf-8'),
+                                'ner' in self.annotators)
+        return tokens_from_columns(text, columns, self.annotators)
+
+    def tokenize_batch(self, texts):
+        """Tokenize several documents per request, up to max_batch_chars."""
+        if any(DOC_SEPARATOR in text for text in texts):
+            return super().tokenize_batch(texts)
+        results = []
+        batch, size = [], 0
+        for text in texts:
+            if batch and size + len(text) > self.max_batch_chars:
+                results.extend(self._tokenize_joined(batch))
+                batch, size = [], 0
+            batch.append(text)
+            size += len(text)
+        if batch:
+            results.extend(self._tokenize_joined(batch))
+        return results
+
+    def _tokenize_joined(self, texts):
+        if len(texts) == 1:
+            return [self.tokenize(texts[0])]
+        joined, starts = join_documents(texts)
+        raw = self._post(joined.encode('utf-8'), self.batch_path).decode('utf-8')
+        columns = decode_output(raw, 'ner' in self.annotators)
+        return split_output(texts, starts, columns, self.annotators)
+
+    def imap(self, texts, chunksize=1):
+        """Tokenize texts concurrently over the connection pool.
+
+        Groups of chunksize texts share one request. Results are yielded in
+        input order.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.pool_size)
+        texts = iter(texts)
+        # Keep a bounded window of requests in flight.
+        pending = collections.deque()
+        while True:
+            chunk = list(itertools.islice(texts, chunksize))
+            if not chunk:
+                break
+            pending.append(self._executor.submit(self.tokenize_batch, chunk))
+            if len(pending) >= 2 * self.pool_size:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+    def shutdown(self):
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        connections = getattr(self, '_connections', None)
+        while connections is not None and not connections.empty():
+            connections.get_nowait().close()
+        if getattr(self, 'server', None) is not None:
+            self.server.terminate()
+            try:
+                self.server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+            self.server = None
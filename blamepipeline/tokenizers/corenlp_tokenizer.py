@@ -9,12 +9,38 @@
 Serves commands to a java subprocess running the jar. Requires java 8.
 """
 
+import bisect
+import itertools
 import json
-import pexpect
+import re
 import copy
 
+import numpy as np
+
 from blamepipeline.tokenizers.tokenizer import Tokens, Tokenizer
-from blamepipeline.blameextract import DEFAULTS
+from blamepipeline.tokenizers import DEFAULTS
+
+# Placed between documents sent in one request. CoreNLP is told to discard it
+# as a sentence boundary, so no sentence spans two documents.
+DOC_SEPARATOR = 'BLAMEPIPELINEDOCSEP'
+
+# Penn Treebank escapes of brackets in CoreNLP's output.
+PTB_ESCAPES = {'-LRB-': '(', '-RRB-': ')', '-LSB-': '[',
+               '-RSB-': ']', '-LCB-': '{', '-RCB-': '}'}
+
+# A json string body, escapes included: CoreNLP writes a quote token as "\"".
+# pos and ner tags are never escaped.
+_STR = r'[^"\\]*(?:\\.[^"\\]*)*'
+
+# The fields we need from one token object of CoreNLP's compact json output,
+# in the order CoreNLP writes them, with and without the ner annotators.
+_TOKEN_RE = re.compile(
+    r'\{"index":(\d+),"word":"(' + _STR + r')","originalText":"' + _STR + r'",'
+    r'"characterOffsetBegin":(\d+),"characterOffsetEnd":(\d+)()')
+_NER_TOKEN_RE = re.compile(
+    r'\{"index":(\d+),"word":"(' + _STR + r')","originalText":"' + _STR + r'","lemma":"' + _STR + r'",'
+    r'"characterOffsetBegin":(\d+),"characterOffsetEnd":(\d+),"pos":"[^"]*",'
+    r'"ner":"([^"]*)"')
 
 
 class CoreNLPTokenizer(Tokenizer):
@@ -24,15 +50,24 @@ class CoreNLPTokenizer(Tokenizer):
         Args:
             classpath: Path to the corenlp directory of jars
             mem: Java heap memory
+            max_batch_chars: Bound on the characters sent in one batched line
         """
         self.classpath = (kwargs.get('classpath') or
                           DEFAULTS['corenlp_classpath'])
         self.annotators = copy.deepcopy(kwargs.get('annotators', set()))
         self.mem = kwargs.get('mem', '2g')
+        self.max_batch_chars = kwargs.get('max_batch_chars', 50000)
         self._launch()
 
+    @classmethod
+    def output_options(cls, options):
+        return {'classpath': options.get('classpath') or DEFAULTS['corenlp_classpath'],
+                'max_batch_chars': options.get('max_batch_chars', 50000)}
+
     def _launch(self):
         """Start the CoreNLP jar with pexpect."""
+        import pexpect
+
         annotators = ['tokenize', 'ssplit']
         if 'ner' in self.annotators:
             annotators.extend(['pos', 'lemma', 'ner'])
@@ -43,6 +78,7 @@ class CoreNLPTokenizer(Tokenizer):
         cmd = ['java', '-mx' + self.mem, '-cp', f'"{self.classpath}"',
                'edu.stanford.nlp.pipeline.StanfordCoreNLP', '-annotators',
                annotators, '-tokenize.options', options,
+               '-ssplit.boundariesToDiscard', DOC_SEPARATOR + ',*NL*',
                '-outputFormat', 'json', '-prettyPrint', 'false']
 
         # We use pexpect to keep the subprocess alive and feed it commands.
@@ -56,21 +92,26 @@ class CoreNLPTokenizer(Tokenizer):
         self.corenlp.delayafterread = 0
         self.corenlp.expect_exact('NLP>', searchwindowsize=100)
 
+    def reset(self):
+        """Start a new CoreNLP process: the REPL of a failed call may still
+        write its output, which the next call would read as its own.
+        """
+        self.corenlp.close(force=True)
+        self._launch()
+
     @staticmethod
     def _convert(token):
-        if token == '-LRB-':
-            return '('
-        if token == '-RRB-':
-            return ')'
-        if token == '-LSB-':
-            return '['
-        if token == '-RSB-':
-            return ']'
-        if token == '-LCB-':
-            return '{'
-        if token == '-RCB-':
-            return '}'
-        return token
+        return PTB_ESCAPES.get(token, token)
+
+    def _annotate(self, text):
+        """Send one line to the REPL and return its raw json output."""
+        self.corenlp.sendline(text.encode('utf-8'))
+        self.corenlp.expect_exact('NLP>', searchwindowsize=100)
+
+        # Skip to start of output (may have been stderr logging messages)
+        output = self.corenlp.before
+        start = output.find(b'{"sentences":')
+        return output[start:].decode('utf-8')
 
     def tokenize(self, text):
         # Since we're feeding text to the commandline, we're waiting on seeing
@@ -82,35 +123,150 @@ class CoreNLPTokenizer(Tokenizer):
         if text.lower().strip() == 'q':
             token = text.strip()
             index = text.index(token)
-            data = [(token, text[index:], (index, index + 1), 'NN', 'q', 'O')]
-            return Tokens(data, self.annotators)
+            return Tokens.from_lists(text, [token], [(index, len(text))], ['O'], [1],
+                                     self.annotators)
 
         # Minor cleanup before tokenizing.
         clean_text = text.replace('\n', ' ')
+        columns = decode_output(self._annotate(clean_text), 'ner' in self.annotators)
+        return tokens_from_columns(text, columns, self.annotators)
 
-        self.corenlp.sendline(clean_text.encode('utf-8'))
-        self.corenlp.expect_exact('NLP>', searchwindowsize=100)
+    def tokenize_batch(self, texts):
+        """Tokenize several documents per REPL line, up to max_batch_chars."""
+        if any('NLP>' in text for text in texts):
+            raise RuntimeError('Bad token (NLP>) in text!')
+        if any(DOC_SEPARATOR in text or text.lower().strip() == 'q'
+               for text in texts):
+            return super().tokenize_batch(texts)
 
-        # Skip to start of output (may have been stderr logging messages)
-        output = self.corenlp.before
-        start = output.find(b'{"sentences":')
-        output = json.loads(output[start:].decode('utf-8'))
-
-        data = []
-        tokens = [[t for t in s['tokens']] for s in output['sentences']]
-        for sent_tokens in tokens:
-            sent = []
-            for i in range(len(sent_tokens)):
-                # Get whitespace
-                start_ws = sent_tokens[i]['characterOffsetBegin']
-                if i + 1 < len(sent_tokens):
-                    end_ws = sent_tokens[i + 1]['characterOffsetBegin']
-                else:
-                    end_ws = sent_tokens[i]['characterOffsetEnd']
-                sent.append((
-                    self._convert(sent_tokens[i]['word']),
-                    text[start_ws: end_ws],
-                    sent_tokens[i].get('ner', None)
-                ))
-            data.append(sent)
-        return Tokens(data, self.annotators)
+        results = []
+        batch, size = [], 0
+        for text in texts:
+            if batch and size + len(text) > self.max_batch_chars:
+                results.extend(self._tokenize_joined(batch))
+                batch, size = [], 0
+            batch.append(text)
+            size += len(text)
+        if batch:
+            results.extend(self._tokenize_joined(batch))
+        return results
+
+    def _tokenize_joined(self, texts):
+        if len(texts) == 1:
+            return [self.tokenize(texts[0])]
+        joined, starts = join_documents(texts)
+        columns = decode_output(self._annotate(joined), 'ner' in self.annotators)
+        return split_output(texts, starts, columns, self.annotators)
+
+
+def join_documents(texts):
+    """Join cleaned texts around DOC_SEPARATOR for a single request.
+
+    Returns the joined text and the offset where each document starts in it.
+    """
+    glue = ' %s ' % DOC_SEPARATOR
+    starts, offset = [], 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text) + len(glue)
+    return glue.join(text.replace('\n', ' ') for text in texts), starts
+
+
+def split_output(texts, starts, columns, annotators):
+    """Split the decoded output of a joined request into one Tokens per text.
+
+    Sentences are assigned to documents by the offset of their first token.
+    """
+    words, begins, ends, ners, sent_lengths = columns
+    sent_starts = list(itertools.accumulate([0] + sent_lengths))
+    docs = [bisect.bisect_right(starts, begins[i]) - 1 for i in sent_starts[:-1]]
+    results = []
+    for doc, (text, start) in enumerate(zip(texts, starts)):
+        lo, hi = bisect.bisect_left(docs, doc), bisect.bisect_right(docs, doc)
+        a, b = sent_starts[lo], sent_starts[hi]
+        results.append(tokens_from_columns(
+            text, (words[a:b], begins[a:b], ends[a:b], ners[a:b], sent_lengths[lo:hi]),
+            annotators, offset=start))
+    return results
+
+
+def match_tokens(raw, ner=False):
+    """Match the token objects of CoreNLP's json output.
+
+    Returns:
+        (index, word, begin, end, ner) strings of every token, words still
+        json escaped, or None if the output does not have the expected layout.
+    """
+    matches = (_NER_TOKEN_RE if ner else _TOKEN_RE).findall(raw)
+    if len(matches) != raw.count('"originalText"'):
+        return None
+    return matches
+
+
+def decode_output(raw, ner=False):
+    """Pull the words, offsets and NER tags out of CoreNLP's json output.
+
+    Only the needed fields are matched in the raw text, so the rest of the
+    payload is never turned into Python objects. Falls back to a full
+    json decode when the output does not have the expected layout.
+
+    Args:
+        raw: json output of CoreNLP
+        ner: Whether the pos, lemma and ner annotators ran
+
+    Returns:
+        Flat lists of words, begin and end offsets and NER tags (None if
+        absent), and the number of tokens of each sentence.
+    """
+    matches = match_tokens(raw, ner=ner)
+    if matches is None:
+        return _decode_json(json.loads(raw))
+    if not matches:
+        return [], [], [], [], []
+    indexes, words, begins, ends, ners = zip(*matches)
+    ners = list(ners) if ner else [None] * len(ners)
+
+    words = [PTB_ESCAPES.get(w, w) if '\\' not in w else json.loads('"%s"' % w)
+             for w in words]
+    # Token indexes restart at 1 in every sentence.
+    sent_starts = [i for i, index in enumerate(indexes) if index == '1']
+    if not sent_starts or sent_starts[0]:
+        sent_starts.insert(0, 0)
+    sent_lengths = [b - a for a, b in zip(sent_starts, sent_starts[1:] + [len(indexes)])]
+    return words, list(map(int, begins)), list(map(int, ends)), ners, sent_lengths
+
+
+def _decode_json(output):
+    words, begins, ends, ners, sent_lengths = [], [], [], [], []
+    for sentence in output['sentences']:
+        if not sentence['tokens']:
+            continue
+        for token in sentence['tokens']:
+            words.append(PTB_ESCAPES.get(token['word'], token['word']))
+            begins.append(token['characterOffsetBegin'])
+            ends.append(token['characterOffsetEnd'])
+            ners.append(token.get('ner', None))
+        sent_lengths.append(len(sentence['tokens']))
+    return words, begins, ends, ners, sent_lengths
+
+
+def tokens_from_columns(text, columns, annotators, offset=0):
+    """Build a Tokens object from the decoded CoreNLP output of text.
+
+    offset is where text starts in the annotated input, for joined requests.
+    """
+    words, begins, ends, ners, sent_lengths = columns
+    begins = np.array(begins, np.int32) - offset
+    ends = np.array(ends, np.int32) - offset
+    # A token's whitespace runs up to the next token of its sentence.
+    ends_ws = np.empty_like(ends)
+    ends_ws[:-1] = begins[1:]
+    last = np.cumsum(sent_lengths, dtype=np.int64) - 1
+    ends_ws[last] = ends[last]
+    return Tokens.from_lists(text, words, np.stack([begins, ends_ws], 1), ners,
+                             sent_lengths, annotators)
+
+
+def tokens_from_json(text, output, annotators, offset=0):
+    """Build a Tokens object from the decoded CoreNLP json output of text."""
+    return tokens_from_columns(text, _decode_json(output), annotators, offset)
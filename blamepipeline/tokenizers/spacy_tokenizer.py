@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Tokenizer that is backed by spaCy (spacy.io).
+
+Requires spaCy and a model with an entity recognizer if ner is used.
+"""
+
+import spacy
+import copy
+
+from blamepipeline.tokenizers.tokenizer import Tokens, Tokenizer
+
+# spaCy entity labels under the names CoreNLP uses.
+NER_TAGS = {'ORG': 'ORGANIZATION', 'GPE': 'LOCATION', 'LOC': 'LOCATION'}
+
+
+class SpacyTokenizer(Tokenizer):
+
+    def __init__(self, **kwargs):
+        """
+        Args:
+            annotators: set that can include ner.
+            model: spaCy model to use (either path, or name like
+              'en_core_web_sm').
+        """
+        model = kwargs.get('model', 'en_core_web_sm')
+        self.annotators = copy.deepcopy(kwargs.get('annotators', set()))
+        disable = ['parser', 'lemmatizer', 'attribute_ruler']
+        if 'ner' not in self.annotators:
+            disable.extend(['tagger', 'tok2vec', 'ner'])
+        self.nlp = spacy.load(model, disable=disable)
+        # Sentences come from the rule based splitter as the parser is off.
+        if 'sentencizer' not in self.nlp.pipe_names:
+            try:
+                self.nlp.add_pipe('sentencizer')
+            except ValueError:
+                # spaCy 2 wants the component itself
+                self.nlp.add_pipe(self.nlp.create_pipe('sentencizer'))
+
+    @classmethod
+    def output_options(cls, options):
+        return {'model': options.get('model', 'en_core_web_sm'), 'spacy': spacy.__version__}
+
+    def _tokens(self, text, doc):
+        ner = 'ner' in self.annotators
+        words, spans, ners, sent_lengths = [], [], [], []
+        for sent in doc.sents:
+            # Whitespace tokens are dropped; their text belongs to the
+            # whitespace of the token before them.
+            sent_tokens = [t for t in sent if not t.is_space]
+            for i, token in enumerate(sent_tokens):
+                if i + 1 < len(sent_tokens):
+                    end_ws = sent_tokens[i + 1].idx
+                else:
+                    end_ws = token.idx + len(token.text)
+                words.append(token.text)
+                spans.append((token.idx, end_ws))
+                if ner:
+                    ners.append(NER_TAGS.get(token.ent_type_, token.ent_type_ or 'O'))
+                else:
+                    ners.append(None)
+            if sent_tokens:
+                sent_lengths.append(len(sent_tokens))
+        return Tokens.from_lists(text, words, spans, ners, sent_lengths,
+                                 self.annotators, opts={'non_ent': 'O'})
+
+    def tokenize(self, text):
+        # We don't treat new lines as tokens.
+        clean_text = text.replace('\n', ' ')
+        return self._tokens(text, self.nlp(clean_text))
+
+    def tokenize_batch(self, texts):
+        docs = self.nlp.pipe(text.replace('\n', ' ') for text in texts)
+        return [self._tokens(text, doc) for text, doc in zip(texts, docs)]
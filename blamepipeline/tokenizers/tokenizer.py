@@ -6,33 +6,144 @@
 # LICENSE file in the root directory of this source tree.
 """Base tokenizer/tokens classes and utilities."""
 
-import copy
+import itertools
+import threading
+
+import numpy as np
+
+
+class Vocabulary(object):
+    """Interned table of token strings shared by all Tokens of a process.
+
+    Tokens store ids into it, so a word seen a million times is kept once.
+    """
+
+    def __init__(self):
+        self.words = []
+        self.lower_words = []
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.words)
+
+    def index(self, word):
+        """Return the id of word, adding it if it is new."""
+        idx = self._ids.get(word)
+        if idx is None:
+            with self._lock:
+                idx = self._ids.get(word)
+                if idx is None:
+                    idx = len(self.words)
+                    self.words.append(word)
+                    lower = word.lower()
+                    self.lower_words.append(word if lower == word else lower)
+                    self._ids[word] = idx
+        return idx
+
+    def get(self, word, default=-1):
+        return self._ids.get(word, default)
+
+
+VOCAB = Vocabulary()
 
 
 class Tokens(object):
-    """A class to represent a list of tokenized text."""
+    """A class to represent a list of tokenized text.
+
+    Tokens are kept in flat typed arrays over a single text buffer:
+    word and NER tag ids into VOCAB, the [start, end) span of each token's
+    text with trailing whitespace, and the offsets where sentences start.
+    Slices share these arrays.
+    """
     TEXT = 0
     TEXT_WS = 1
     NER = 2
 
-    def __init__(self, data, annotators, opts=None):
-        self.data = data
+    def __init__(self, text, word_ids, spans, ner_ids, sent_bounds,
+                 annotators, opts=None):
+        """
+        Args:
+            text: Text the spans index into
+            word_ids: int32 array of VOCAB ids, one per token
+            spans: int32 array [num_tokens, 2] of text (with whitespace) spans
+            ner_ids: int32 array of VOCAB ids of the NER tags (-1 if absent)
+            sent_bounds: int32 array of sentence start offsets, plus the end
+            annotators: Annotators the tokenizer ran
+        """
+        self.text = text
+        self.word_ids = word_ids
+        self.spans = spans
+        self.ner_ids = ner_ids
+        self.sent_bounds = sent_bounds
         self.annotators = annotators
         self.opts = opts or {}
 
+    @classmethod
+    def from_lists(cls, text, words, spans, ners, sent_lengths, annotators,
+                   opts=None):
+        """Build Tokens from flat lists of words, spans and NER tags.
+
+        Args:
+            words: token strings
+            spans: (start, end) text spans with trailing whitespace
+            ners: NER tags (None if absent)
+            sent_lengths: number of tokens of each sentence
+        """
+        index = VOCAB.index
+        word_ids = np.fromiter((index(w) for w in words), np.int32, len(words))
+        ner_ids = np.fromiter((-1 if t is None else index(t) for t in ners),
+                              np.int32, len(ners))
+        spans = np.array(spans, np.int32).reshape(-1, 2)
+        sent_bounds = np.zeros(len(sent_lengths) + 1, np.int32)
+        np.cumsum(sent_lengths, out=sent_bounds[1:])
+        return cls(text, word_ids, spans, ner_ids, sent_bounds, annotators, opts)
+
     def __len__(self):
         """The number of tokens."""
-        return len(self.data)
+        return len(self.word_ids)
+
+    def __getstate__(self):
+        # Ids are only valid in this process's VOCAB: pickle the strings.
+        state = self.__dict__.copy()
+        for key in ('word_ids', 'ner_ids'):
+            ids, inverse = np.unique(state.pop(key), return_inverse=True)
+            state[key] = ([VOCAB.words[i] if i >= 0 else None for i in ids.tolist()],
+                          inverse.astype(np.int32))
+        return state
+
+    def __setstate__(self, state):
+        for key in ('word_ids', 'ner_ids'):
+            table, inverse = state[key]
+            ids = np.array([-1 if w is None else VOCAB.index(w) for w in table], np.int32)
+            state[key] = ids[inverse]
+        self.__dict__.update(state)
+
+    def _sentences(self):
+        bounds = self.sent_bounds.tolist()
+        return zip(bounds[:-1], bounds[1:])
 
     def slice(self, sent_no=None, i=None, j=None):
-        """Return a view of the list of tokens from [i, j)."""
-        new_tokens = copy.copy(self)
-        new_tokens.data = self.data[sent_no][i: j]
-        return new_tokens
+        """Return a view of the list of tokens from [i, j).
+
+        Indices are within sentence sent_no, or over all tokens if None.
+        """
+        if sent_no is None:
+            lo, hi = 0, len(self)
+        else:
+            lo, hi = int(self.sent_bounds[sent_no]), int(self.sent_bounds[sent_no + 1])
+        start, stop, _ = slice(i, j).indices(hi - lo)
+        start, stop = lo + start, lo + max(start, stop)
+        bounds = np.clip(self.sent_bounds, start, stop) - start
+        bounds = np.concatenate([[0], bounds[(bounds > 0) & (bounds < stop - start)],
+                                 [stop - start]]).astype(np.int32)
+        return Tokens(self.text, self.word_ids[start:stop], self.spans[start:stop],
+                      self.ner_ids[start:stop], bounds, self.annotators, self.opts)
 
     def untokenize(self):
         """Returns the original text (with whitespace reinserted)."""
-        return ''.join([t[self.TEXT_WS] for t in self.data]).strip()
+        return ''.join([self.text[self.spans[b, 0]: self.spans[e - 1, 1]]
+                        for b, e in self._sentences() if e > b]).strip()
 
     def words(self, uncased=False):
         """Returns a list of the text of each token
@@ -40,10 +151,9 @@ class Tokens(object):
         Args:
             uncased: lower cases text
         """
-        if uncased:
-            return [[t[self.TEXT].lower() for t in s] for s in self.data]
-        else:
-            return [[t[self.TEXT] for t in s] for s in self.data]
+        table = VOCAB.lower_words if uncased else VOCAB.words
+        ids = self.word_ids.tolist()
+        return [[table[i] for i in ids[b: e]] for b, e in self._sentences()]
 
     def entities(self):
         """Returns a list of named-entity-recognition tags of each token.
@@ -51,28 +161,41 @@ class Tokens(object):
         """
         if 'ner' not in self.annotators:
             return None
-        return [[t[self.NER] for t in s] for s in self.data]
+        table = VOCAB.words
+        ids = self.ner_ids.tolist()
+        return [[table[i] if i >= 0 else None for i in ids[b: e]]
+                for b, e in self._sentences()]
+
+    @property
+    def data(self):
+        """Nested (word, text_ws, ner) tuples per sentence, as built before
+        Tokens were array backed.
+        """
+        words = VOCAB.words
+        return [[(words[w], self.text[s: e], words[n] if n >= 0 else None)
+                 for w, (s, e), n in zip(self.word_ids[b: f].tolist(),
+                                         self.spans[b: f].tolist(),
+                                         self.ner_ids[b: f].tolist())]
+                for b, f in self._sentences()]
 
     def entity_groups(self):
         """Group consecutive entity tokens with the same NER tag."""
-        entities = self.entities()
-        if not entities:
+        if 'ner' not in self.annotators or not len(self):
             return None
-        non_ent = self.opts.get('non_ent', 'O')
+        non_ent = VOCAB.get(self.opts.get('non_ent', 'O'))
+        ner = self.ner_ids
+        # A run starts where the tag changes or a sentence begins.
+        run_start = np.ones(len(ner), bool)
+        run_start[1:] = ner[1:] != ner[:-1]
+        run_start[self.sent_bounds[:-1][self.sent_bounds[:-1] < len(ner)]] = True
+        starts = np.flatnonzero(run_start)
+        ends = np.append(starts[1:], len(ner))
+        keep = ner[starts] != non_ent
         groups = []
-        for sent_no, ents in enumerate(entities):
-            idx = 0
-            while idx < len(ents):
-                ner_tag = ents[idx]
-                # Check for entity tag
-                if ner_tag != non_ent:
-                    # Chomp the sequence
-                    start = idx
-                    while (idx < len(ents) and ents[idx] == ner_tag):
-                        idx += 1
-                    groups.append((self.slice(sent_no, start, idx).untokenize(), ner_tag))
-                else:
-                    idx += 1
+        for start, end, tag in zip(starts[keep].tolist(), ends[keep].tolist(),
+                                   ner[starts[keep]].tolist()):
+            groups.append((self.text[self.spans[start, 0]: self.spans[end - 1, 1]].strip(),
+                           VOCAB.words[tag] if tag >= 0 else None))
         return groups
 
 
@@ -81,9 +204,43 @@ class Tokenizer(object):
     Tokenizers implement tokenize, which should return a Tokens class.
     """
 
+    @classmethod
+    def output_options(cls, options):
+        """The options (constructor kwargs) that change the Tokens, with
+        their defaults, e.g. to key cached Tokens. Annotators excluded.
+        """
+        return {}
+
     def tokenize(self, text):
         raise NotImplementedError
 
+    def tokenize_batch(self, texts):
+        """Tokenize a list of texts, returning a list of Tokens.
+
+        Tokenizers that can annotate several documents in one request
+        override this.
+        """
+        return [self.tokenize(text) for text in texts]
+
+    def imap(self, texts, chunksize=1):
+        """Lazily tokenize an iterable of texts, yielding Tokens in order.
+
+        Texts are passed to tokenize_batch in groups of chunksize.
+        Tokenizers that can have several documents in flight override this.
+        """
+        texts = iter(texts)
+        while True:
+            chunk = list(itertools.islice(texts, chunksize))
+            if not chunk:
+                break
+            yield from self.tokenize_batch(chunk)
+
+    def reset(self):
+        """Bring the tokenizer back to a clean state after a failed call,
+        e.g. one that timed out with its output still pending.
+        """
+        pass
+
     def shutdown(self):
         pass
 
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Run several tokenizer instances in worker processes.
+
+Each worker owns one tokenizer (e.g. one CoreNLP JVM). Texts are sent to the
+workers in chunks and the resulting Tokens are streamed back in input order.
+Workers that die are restarted and their unfinished chunks are resent.
+"""
+
+import collections
+import copy
+import itertools
+import multiprocessing
+import queue
+import traceback
+
+from blamepipeline.tokenizers.tokenizer import Tokenizer
+
+
+def _work(tokenizer_class, options, inbox, outbox):
+    """Worker loop: tokenize chunks from inbox until a None task arrives."""
+    tokenizer = tokenizer_class(**options)
+    try:
+        while True:
+            task = inbox.get()
+            if task is None:
+                break
+            chunk_id, texts = task
+            try:
+                result = tokenizer.tokenize_batch(texts)
+            except Exception:
+                outbox.put((chunk_id, False, traceback.format_exc()))
+                tokenizer.reset()
+            else:
+                outbox.put((chunk_id, True, result))
+    finally:
+        tokenizer.shutdown()
+
+
+class TokenizerPool(Tokenizer):
+    """A pool of tokenizer worker processes.
+
+    Not thread safe: iterate one imap() at a time.
+    """
+
+    POLL_INTERVAL = 1
+
+    def __init__(self, tokenizer_class, num_workers=None, options=None,
+                 prefetch=2, max_retries=2):
+        """
+        Args:
+            tokenizer_class: Tokenizer subclass to run in each worker
+            num_workers: Number of worker processes (default: cpu count)
+            options: kwargs for the tokenizer constructor
+            prefetch: Chunks queued on each worker ahead of the current one
+            max_retries: Times a chunk is resent after its worker crashed
+        """
+        self.tokenizer_class = tokenizer_class
+        self.options = options or {}
+        self.annotators = copy.deepcopy(self.options.get('annotators', set()))
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.prefetch = prefetch
+        self.max_retries = max_retries
+
+        self._outbox = multiprocessing.Queue()
+        self._workers = [None] * self.num_workers
+        self._inboxes = [None] * self.num_workers
+        # chunk ids sent to each worker and not answered yet
+        self._assigned = [collections.deque() for _ in range(self.num_workers)]
+        # chunk id -> [texts, retries] for chunks the current imap waits on
+        self._tasks = {}
+        self._resend = collections.deque()
+        self._chunk_ids = itertools.count()
+        for i in range(self.num_workers):
+            self._start(i)
+
+    def _start(self, i):
+        self._inboxes[i] = multiprocessing.Queue()
+        self._workers[i] = multiprocessing.Process(
+            target=_work,
+            args=(self.tokenizer_class, self.options,
+                  self._inboxes[i], self._outbox),
+            daemon=True)
+        self._workers[i].start()
+
+    def restart(self):
+        """Restart crashed workers and resend the chunks they held.
+
+        Returns the number of restarted workers.
+        """
+        restarted = 0
+        for i, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+            worker.join()
+            for chunk_id in self._assigned[i]:
+                if chunk_id not in self._tasks:
+                    continue
+                self._tasks[chunk_id][1] += 1
+                if self._tasks[chunk_id][1] > self.max_retries:
+                    raise RuntimeError(
+                        'Tokenizer worker crashed %d times on the same chunk '
+                        '(exit code %s)' % (self._tasks[chunk_id][1], worker.exitcode))
+                self._resend.append(chunk_id)
+            self._assigned[i].clear()
+            self._inboxes[i].close()
+            self._start(i)
+            restarted += 1
+        return restarted
+
+    def _dispatch(self, chunk_id):
+        """Send a chunk to the least loaded worker."""
+        i = min(range(self.num_workers), key=lambda i: len(self._assigned[i]))
+        self._assigned[i].append(chunk_id)
+        self._inboxes[i].put((chunk_id, self._tasks[chunk_id][0]))
+
+    def _has_capacity(self):
+        return any(len(a) < self.prefetch for a in self._assigned)
+
+    def _receive(self):
+        """Wait for one finished chunk. Returns None on a poll timeout."""
+        try:
+            chunk_id, ok, result = self._outbox.get(timeout=self.POLL_INTERVAL)
+        except queue.Empty:
+            self.restart()
+            return None
+        for assigned in self._assigned:
+            if chunk_id in assigned:
+                assigned.remove(chunk_id)
+                break
+        if chunk_id not in self._tasks:
+            # answer to a resent chunk or to an abandoned imap
+            return None
+        if not ok:
+            raise RuntimeError('Tokenizer worker failed:\n' + result)
+        del self._tasks[chunk_id]
+        return chunk_id, result
+
+    def tokenize(self, text):
+        return next(iter(self.imap([text])))
+
+    def tokenize_batch(self, texts):
+        """Spread texts evenly over the workers."""
+        chunksize = max(1, -(-len(texts) // self.num_workers))
+        return list(self.imap(texts, chunksize))
+
+    def imap(self, texts, chunksize=1):
+        """Tokenize texts on the workers, yielding Tokens in input order.
+
+        Args:
+            texts: iterable of strings, consumed lazily
+            chunksize: number of texts sent to a worker at once
+        """
+        texts = iter(texts)
+        order = collections.deque()
+        done = {}
+        exhausted = False
+        try:
+            while True:
+                # Keep every worker busy, but don't run too far ahead of
+                # the chunk the caller is waiting on.
+                while self._resend and self._has_capacity():
+                    chunk_id = self._resend.popleft()
+                    if chunk_id in self._tasks:
+                        self._dispatch(chunk_id)
+                while (not exhausted and self._has_capacity() and
+                       len(order) < 2 * self.prefetch * self.num_workers):
+                    chunk = list(itertools.islice(texts, chunksize))
+                    if not chunk:
+                        exhausted = True
+                        break
+                    chunk_id = next(self._chunk_ids)
+                    self._tasks[chunk_id] = [chunk, 0]
+                    order.append(chunk_id)
+                    self._dispatch(chunk_id)
+                if not order:
+                    break
+                received = self._receive()
+                if received:
+                    done[received[0]] = received[1]
+                while order and order[0] in done:
+                    yield from done.pop(order.popleft())
+        finally:
+            for chunk_id in order:
+                self._tasks.pop(chunk_id, None)
+            self._resend.clear()
+
+    def shutdown(self):
+        workers = getattr(self, '_workers', [])
+        for inbox, worker in zip(getattr(self, '_inboxes', []), workers):
+            if worker is not None and worker.is_alive():
+                inbox.put(None)
+        for worker in workers:
+            if worker is None:
+                continue
+            worker.join(timeout=30)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._workers = []
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmark of decoding CoreNLP json output into Tokens.
+
+Builds the output CoreNLP gives for a synthetic article (tokenize, ssplit,
+pos, lemma, ner) and times the full json decode against the projection
+decoder. Articles have quoted speech, whose escaped quotes the projection
+decoder must handle without falling back to the full decode; how often it
+falls back is reported. No java needed.
+'''
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+# run from a checkout without installing the package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from blamepipeline.tokenizers.corenlp_tokenizer import (  # noqa: E402
+    _decode_json, decode_output, match_tokens, tokens_from_columns, tokens_from_json)
+
+WORDS = ['the', 'president', 'said', 'that', 'Congress', 'failed', 'to', 'pass',
+         'a', 'budget', 'and', 'blamed', 'Democrats', 'for', 'shutdown', 'of',
+         'government', 'on', 'Monday', 'Obama', 'Hannity', 'in', 'Washington']
+# CoreNLP's words for quotes, their original text is a (json escaped) "
+QUOTES = {'``': '"', "''": '"'}
+NER = {'Congress': 'ORGANIZATION', 'Democrats': 'ORGANIZATION', 'Monday': 'DATE',
+       'Obama': 'PERSON', 'Hannity': 'PERSON', 'Washington': 'LOCATION'}
+
+
+def make_article(num_words, seed=0):
+    '''Return the text of an article and CoreNLP's json output for it.'''
+    rng = random.Random(seed)
+    pieces, sentences, tokens = [], [], []
+    offset = 0
+    for i in range(num_words):
+        if tokens and (len(tokens) >= 25 or rng.random() < 0.04):
+            word = '.'
+        elif rng.random() < 0.02:
+            word = '-LRB-' if rng.random() < 0.5 else '-RRB-'
+        elif rng.random() < 0.05:
+            # quoted speech
+            word = '``' if rng.random() < 0.5 else "''"
+        else:
+            word = rng.choice(WORDS)
+        original = {'-LRB-': '(', '-RRB-': ')', **QUOTES}.get(word, word)
+        if word != '.' and pieces:
+            pieces.append(' ')
+            offset += 1
+        tokens.append({'index': len(tokens) + 1, 'word': word, 'originalText': original,
+                       'lemma': original.lower(), 'characterOffsetBegin': offset,
+                       'characterOffsetEnd': offset + len(original), 'pos': 'NN',
+                       'ner': NER.get(word, 'O'), 'before': ' ', 'after': ' '})
+        pieces.append(original)
+        offset += len(original)
+        if word == '.':
+            sentences.append({'index': len(sentences), 'entitymentions': [], 'tokens': tokens})
+            tokens = []
+    if tokens:
+        sentences.append({'index': len(sentences), 'entitymentions': [], 'tokens': tokens})
+    return ''.join(pieces), json.dumps({'sentences': sentences}, separators=(',', ':'))
+
+
+def falls_back(raw, ner=True):
+    """Whether decode_output falls back to the full json decode for raw."""
+    return match_tokens(raw, ner=ner) is None
+
+
+def main(args):
+    articles = [make_article(args.words, seed) for seed in range(args.articles)]
+    annotators = {'ner'}
+    for text, raw in articles:
+        old = tokens_from_json(text, json.loads(raw), annotators)
+        new = tokens_from_columns(text, decode_output(raw, ner=True), annotators)
+        assert old.data == new.data, 'decoders disagree'
+    fallbacks = sum(1 for _, raw in articles if falls_back(raw))
+
+    def decode_all(decode):
+        return lambda: [decode(text, raw) for text, raw in articles]
+
+    timings = {
+        'json.loads': decode_all(lambda text, raw: tokens_from_json(text, json.loads(raw), annotators)),
+        'projection': decode_all(
+            lambda text, raw: tokens_from_columns(text, decode_output(raw, ner=True), annotators)),
+        # the decode step only, without building the Tokens
+        'json.loads (decode)': decode_all(lambda text, raw: _decode_json(json.loads(raw))),
+        'projection (decode)': decode_all(lambda text, raw: decode_output(raw, ner=True)),
+    }
+    quotes = sum(raw.count('\\"') for _, raw in articles) // 2
+    print(f'{len(articles)} articles of {len(new)} tokens, {len(articles[-1][1]) / 1024:.0f} KB of json, '
+          f'{quotes / len(articles):.0f} quote tokens per article')
+    print(f'projection fell back to json.loads for {fallbacks}/{len(articles)} articles')
+    results = {}
+    for name, fn in timings.items():
+        results[name] = min(timeit.repeat(fn, number=args.number, repeat=args.repeat)) / args.number / len(articles)
+        print(f'{name:>20}: {results[name] * 1000:.2f} ms/article')
+    print(f'speedup: {results["json.loads"] / results["projection"]:.2f}x, decode step '
+          f'{results["json.loads (decode)"] / results["projection (decode)"]:.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark CoreNLP output decoding')
+    parser.add_argument('--words', type=int, default=5000)
+    parser.add_argument('--articles', type=int, default=10)
+    parser.add_argument('--number', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+    main(args)
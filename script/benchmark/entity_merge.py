@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Time entity alias merging on synthetic entity sets of growing size.
+'''
+
+import argparse
+import random
+import time
+
+from blamepipeline.preprocess.entity_merge import entity_merge
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def make_entities(num, vocab, seed=0):
+    '''Return num distinct entities of 1-4 random capitalized words.'''
+    rng = random.Random(seed)
+    words = list({''.join(rng.choice(LETTERS) for _ in range(rng.randint(3, 9))).title()
+                  for _ in range(vocab)})
+    entities = set()
+    while len(entities) < num:
+        length = rng.choices([1, 2, 3, 4], [3, 4, 2, 1])[0]
+        entities.add(tuple(rng.choice(words) for _ in range(length)))
+    return entities
+
+
+def main(args):
+    for num in args.sizes:
+        entities = make_entities(num, args.vocab)
+        start = time.perf_counter()
+        entity2id, entity2alias = entity_merge(entities)
+        elapsed = time.perf_counter() - start
+        print(f'{num:>8} entities -> {len(entity2alias):>8} ids: {elapsed:.2f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark entity alias merging')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25000, 50000, 100000])
+    parser.add_argument('--vocab', type=int, default=30000)
+    args = parser.parse_args()
+    main(args)
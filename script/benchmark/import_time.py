@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Check that importing blamepipeline stays cheap.
+
+Imports the package in fresh interpreters with -X importtime and exits with
+a non-zero status if the import takes longer than the budget, or if it
+loads one of the heavy optional backends.
+'''
+
+import argparse
+import subprocess
+import sys
+
+HEAVY = ['spacy', 'pexpect', 'torch', 'allennlp', 'numpy']
+PROBE = ('import sys, blamepipeline, blamepipeline.tokenizers\n'
+         'print(",".join(m for m in {} if m in sys.modules))'.format(HEAVY))
+
+
+def import_time(modules, probe):
+    '''Return the cumulative import time of modules in us, and probe's output.'''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    total = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() in modules:
+            total += int(fields[1])
+    return total, result.stdout.strip()
+
+
+def main(args):
+    times = []
+    for _ in range(args.repeat):
+        total, loaded = import_time({'blamepipeline', 'blamepipeline.tokenizers'}, PROBE)
+        times.append(total)
+    best = min(times) / 1000
+    print(f'import blamepipeline: {best:.1f} ms (best of {args.repeat}), budget {args.budget} ms')
+    failed = False
+    if loaded:
+        print(f'FAIL: heavy modules loaded at import: {loaded}')
+        failed = True
+    if best > args.budget:
+        print('FAIL: over budget')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time check')
+    parser.add_argument('--budget', type=float, default=50,
+                        help='budget in ms for import blamepipeline')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args)
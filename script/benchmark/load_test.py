@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Load test a running script/serve.py: concurrent clients send scoring
+requests over kept-alive connections, then the client latencies and the
+service histograms are printed.
+
+Pair requests are synthetic (random words and entities) and need no
+tokenizer. Article requests send the 'content' of a JSONL file of articles.
+'''
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+WORDS = ['the', 'said', 'blamed', 'for', 'of', 'a', 'to', 'and', 'in', 'that',
+         'policy', 'crisis', 'failure', 'economy', 'border', 'health', 'care', 'tax']
+
+
+def make_pairs_request(rng, num_sents=6, num_entities=4):
+    '''Return a random /score/pairs request.'''
+    sents = [[rng.choice(WORDS) for _ in range(rng.randint(8, 30))] for _ in range(num_sents)]
+    entities = [f'entity {i}' for i in range(num_entities)]
+    epos = {}
+    for e in entities:
+        positions = set()
+        for _ in range(rng.randint(1, 3)):
+            si = rng.randrange(num_sents)
+            positions.add((si, rng.randrange(len(sents[si]))))
+        epos[e] = []
+        for si, wi in sorted(positions):
+            if sents[si][wi] not in epos:
+                sents[si][wi] = e
+                epos[e].append((si, wi))
+    entities = [e for e in entities if epos[e]]
+    epos = {e: epos[e] for e in entities}
+    pairs = [(src, tgt) for src in entities for tgt in entities if src != tgt]
+    return {'sents': sents, 'epos': epos, 'pairs': pairs}
+
+
+async def request(reader, writer, host, method, path, payload=None):
+    '''Send a request on a kept-alive connection, return status and JSON response.'''
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write((f'{method} {path} HTTP/1.1\r\nHost: {host}\r\n'
+                  f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    data = await reader.readexactly(int(headers['content-length']))
+    return status, json.loads(data)
+
+
+async def client(args, payloads, latencies, errors):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while payloads:
+            payload = payloads.pop()
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, args.host, 'POST', args.path, payload)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.articles:
+        with open(args.articles) as f:
+            articles = [{'content': json.loads(line)['content']} for line in f if line.strip()]
+        payloads = [rng.choice(articles) for _ in range(args.requests)]
+        args.path = '/score/article'
+    else:
+        payloads = [make_pairs_request(rng, args.sents, args.entities) for _ in range(args.requests)]
+        args.path = '/score/pairs'
+
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(args, payloads, latencies, errors) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    print(f'{len(latencies)} requests to {args.path}, concurrency {args.concurrency}: '
+          f'{elapsed:.2f} s, {len(latencies) / elapsed:.1f} requests/s, {len(errors)} errors')
+    print('latency ms: ' + ', '.join(f'p{int(q * 100)} {percentile(latencies, q) * 1e3:.1f}'
+                                     for q in (0.5, 0.9, 0.99)) +
+          f', max {max(latencies) * 1e3:.1f}')
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, metrics = await request(reader, writer, args.host, 'GET', '/metrics')
+    writer.close()
+    for name, histogram in metrics['batch_size'].items():
+        if histogram['count']:
+            print(f'service {name} batch size: mean {histogram["mean"]:.1f}, p50 <= {histogram["p50"]}, '
+                  f'p99 <= {histogram["p99"]} ({histogram["count"]} batches)')
+    for name, histogram in metrics['latency'].items():
+        if histogram['count']:
+            print(f'service {name} latency: mean {histogram["mean"] * 1e3:.1f} ms, '
+                  f'p50 <= {histogram["p50"] * 1e3:g} ms, p99 <= {histogram["p99"] * 1e3:g} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the blame scoring service')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent connections')
+    parser.add_argument('--articles', type=str, default=None,
+                        help='JSONL file of articles to send to /score/article, else synthetic pairs')
+    parser.add_argument('--sents', type=int, default=6, help='sentences of a synthetic request')
+    parser.add_argument('--entities', type=int, default=4, help='entities of a synthetic request')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
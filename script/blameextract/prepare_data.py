@@ -9,21 +9,25 @@
 '''
 Within an article, merge the same entities and construct a map from entity name to entity id.
 In the blame tie and article content, replace entity names by its id.
+
+The samples files have a record with the sentences of each article
+({'id', 'sents'}) before the samples (entity pairs) that refer to it.
 '''
 
 import argparse
-from collections import defaultdict
+from contextlib import ExitStack
 import os
 import json
 import pickle  # json cannot accpet tuple key
 from itertools import permutations
-from statistics import mean, stdev
 
 from termcolor import colored
 from tqdm import tqdm
 
 
 from blamepipeline import DATA_DIR as DATA_ROOT
+from blamepipeline.preprocess.entity_merge import entity_merge
+from blamepipeline.preprocess.entity_tag import EntityTagger
 
 DATA_DIR = DATA_ROOT
 
@@ -52,36 +56,7 @@ def entity_merge_global(args):
         for line in f:
             all_ents |= {tuple(e) for e in json.loads(line)['entities']}
 
-    # one step transform
-    transform_d = {}
-    for e in tqdm(all_ents, total=len(all_ents), desc='find transforms'):
-        for e_ in all_ents:
-            if len(e) <= 1 or e == e_:
-                continue
-            if ' '.join(e) in ' '.join(e_):
-                transform_d[e] = e_
-                e = e_
-            elif ' '.join(e_) in ' '.join(e):
-                transform_d[e_] = e
-            elif len(e) == 2 and len(e_) == 3 and e[0] == e_[0] and e[-1] == e_[-1] and e_[1].endswith('.'):
-                # middle name
-                transform_d[e] = e_
-                print(f'{e} -> {e_}')
-            elif len(e) == 3 and len(e_) == 2 and e[0] == e_[0] and e[-1] == e_[-1] and e[1].endswith('.'):
-                transform_d[e_] = e
-                print(f'{e_} -> {e}')
-
-    # construct dict
-    entity2id = {}
-    entity2alias = defaultdict(set)
-    for e in all_ents:
-        e_ = e
-        while e_ in transform_d:
-            e_ = transform_d[e_]
-        entity2id[e] = ' '.join(e_)
-        entity2alias[e_].add(e)
-    # sort by entity len
-    entity2alias = {e: sorted(alias, key=lambda t: -len(t)) for e, alias in entity2alias.items()}
+    entity2id, entity2alias = entity_merge(all_ents)
     # save
     with open(entity_json_path, 'w') as entity_j,\
             open(entity_txt_path, 'w') as entity_t:
@@ -98,33 +73,89 @@ def entity_merge_global(args):
 
 
 def entity_merge_local(entities):
-    # one step transform
-    transform_d = {}
-    for e in entities:
-        for e_ in entities:
-            if len(e) <= 1 or e == e_:
-                continue
-            if ' '.join(e) in ' '.join(e_):
-                transform_d[e] = e_
-                e = e_
-            elif ' '.join(e_) in ' '.join(e):
-                transform_d[e_] = e
-            elif len(e) == 2 and len(e_) == 3 and e[0] == e_[0] and e[-1] == e_[-1] and e_[1].endswith('.'):
-                # middle name
-                transform_d[e] = e_
-            elif len(e) == 3 and len(e_) == 2 and e[0] == e_[0] and e[-1] == e_[-1] and e[1].endswith('.'):
-                transform_d[e_] = e
-    entity2id = {}
-    entity2alias = defaultdict(set)
-    for e in entities:
-        e_ = e
-        while e_ in transform_d:
-            e_ = transform_d[e_]
-        entity2id[e] = ' '.join(e_)
-        entity2alias[e_].add(e)
+    entity2id, _ = entity_merge(entities)
     return entity2id
 
 
+class RunningStats():
+    '''
+    Mean and standard deviation of a stream of numbers (Welford's method).
+    The numbers themselves are only kept if keep.
+    '''
+
+    def __init__(self, keep=False):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.values = [] if keep else None
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if self.values is not None:
+            self.values.append(x)
+
+    @property
+    def stdev(self):
+        return (self.m2 / (self.n - 1)) ** 0.5 if self.n > 1 else 0.0
+
+
+def tag_article(d, entity2id, args):
+    '''
+    Replace the entities in the content of an article by their ids.
+    entity2id: global merge dict, or None to merge within the article
+    Return: content, epos, all_entities_ids, pairs_entities_ids (of the entities
+            found in content), numbers of entities and blame entities not found
+    '''
+    content = d['content']
+    pairs = sorted({(tuple(p['source']), tuple(p['target'])) for p in d['pairs']})
+    if args.all_entities:
+        all_entities = sorted({tuple(e) for e in d['entities']})
+    else:
+        all_entities = sorted({e for p in pairs for e in p})
+    if entity2id is None:
+        entity2id = entity_merge_local(all_entities)
+    pairs_entities_ids = sorted({(entity2id[s], entity2id[t])
+                                 for s, t in pairs if entity2id[s] != entity2id[t]})
+    all_entities_ids = sorted({entity2id[e] for e in all_entities})
+
+    # merge entity words in *content* into a single token, and replace by id
+    # sorted ents by word len to avoid mismatch
+    all_entities = sorted(all_entities, key=lambda t: -len(t))
+    # and find positions for entities
+    epos = EntityTagger(all_entities, entity2id).tag(content)
+
+    all_entities_mismatch = sum(1 for e in all_entities_ids if e not in epos)
+    tie_entities_mismatch = sum(1 for p in pairs_entities_ids for e in p if e not in epos)
+
+    # # remove entities which cannot be found in article
+    all_entities_ids = sorted({e for e in all_entities_ids if e in epos})
+    pairs_entities_ids = sorted({(s, t) for s, t in pairs_entities_ids if s in epos and t in epos})
+    return content, epos, all_entities_ids, pairs_entities_ids, all_entities_mismatch, tie_entities_mismatch
+
+
+def article_samples(content, epos, all_entities_ids, pairs_entities_ids, args):
+    '''
+    Generate the samples of an article: every ordered pair of its entities
+    with the sentences they occur in. A sample refers to the sentences by
+    their index in content (sent_ids), src_pos and tgt_pos index sent_ids.
+    '''
+    for src, tgt in permutations(all_entities_ids, 2):
+        if not args.ignore_direction:
+            label = 1 if (src, tgt) in pairs_entities_ids else 0
+        else:
+            label = 1 if (src, tgt) in pairs_entities_ids or (tgt, src) in pairs_entities_ids else 0
+        sent_ids = list({si for si, _ in epos[src] + epos[tgt]})
+        sents = [content[si] for si in sent_ids]
+        s_pos = [(sents.index(content[si]), wi) for si, wi in epos[src]]
+        t_pos = [(sents.index(content[si]), wi) for si, wi in epos[tgt]]
+        yield {'src_pos': s_pos, 'tgt_pos': t_pos,
+               'src': src, 'tgt': tgt,
+               'sent_ids': sent_ids, 'label': label}
+
+
 def main(args):
     args.samples_file = os.path.join(DATA_DIR, args.samples_file)
     args.dataset_file = os.path.join(DATA_DIR, args.dataset_file)
@@ -135,230 +166,141 @@ def main(args):
         args.samples_file = fname + '-directed' + ext
     print(args)
 
+    entity2id = None
     if args.merge_entity == 'global':
         entity2id = entity_merge_global(args)
 
     # debug
     num_articles, num_samples, num_pos_samples = 0, 0, 0
     all_entities_mismatch, tie_entities_mismatch = 0, 0
-    num_entities_dist, samples_ratio_dist, blame_tie_dist = [], [], []
+    keep = args.save_stats or args.plt_stats
+    num_entities_dist, samples_ratio_dist, blame_tie_dist = RunningStats(keep), RunningStats(keep), RunningStats(keep)
 
-    samples = []
+    # Samples are written as articles stream, so the articles with samples
+    # are counted first to know where the splits start. The lines of the
+    # articles without samples are recorded, and not tagged again.
+    lines, skip_lines = 0, set()
     with open(args.dataset_file) as f:
-        lines = sum((1 for _ in f))
-    with open(args.dataset_file) as f:
-        for line in tqdm(f, total=lines, desc='generate samples'):
-            d = json.loads(line)
-            content = d['content']
-            pairs = sorted({(tuple(p['source']), tuple(p['target'])) for p in d['pairs']})
-            if args.all_entities:
-                all_entities = sorted({tuple(e) for e in d['entities']})
-            else:
-                all_entities = sorted({e for p in pairs for e in p})
-            if args.merge_entity == 'local':
-                entity2id = entity_merge_local(all_entities)
-            pairs_entities_ids = sorted({(entity2id[s], entity2id[t])
-                                         for s, t in pairs if entity2id[s] != entity2id[t]})
-            all_entities_ids = sorted({entity2id[e] for e in all_entities})
-
-            # merge entity words in *content* into a single token, and replace by id
-            # sorted ents by word len to avoid mismatch
-            all_entities = sorted(all_entities, key=lambda t: -len(t))
-            epos = defaultdict(list)
-            for si, s in enumerate(content):
-                wi = 0
-                while wi < len(s):
-                    for e in all_entities:
-                        e_list, e_len = list(e), len(e)
-                        if s[wi: wi + e_len] == e_list or\
-                                s[wi: wi + e_len - 1] == e_list[:-1] and s[wi + e_len - 1] == e_list[-1] + '.':
-                            s[wi: wi + e_len] = [entity2id[e]]
-                            break
-                    wi += 1
-
-            # find positions for entities
-            epos = defaultdict(list)
-            for si, s in enumerate(content):
-                for wi, w in enumerate(s):
-                    if w in all_entities_ids:
-                        epos[w].append((si, wi))
-
-            for i, e in enumerate(all_entities_ids):
-                if e not in epos:
-                    all_entities_mismatch += 1
-            for p in pairs_entities_ids:
-                for e in p:
-                    if e not in epos:
-                        tie_entities_mismatch += 1
-
-            # # remove entities which cannot be found in article
-            all_entities_ids = sorted({e for e in all_entities_ids if e in epos})
-            pairs_entities_ids = sorted({(s, t) for s, t in pairs_entities_ids if s in epos and t in epos})
+        for line_no, line in enumerate(tqdm(f, desc='count articles')):
+            lines += 1
+            if args.split:
+                _, _, _, pairs_entities_ids, all_mismatch, tie_mismatch = \
+                    tag_article(json.loads(line), entity2id, args)
+                if not pairs_entities_ids:
+                    skip_lines.add(line_no)
+                    all_entities_mismatch += all_mismatch
+                    tie_entities_mismatch += tie_mismatch
+
+    if args.split:
+        total_articles = lines - len(skip_lines)
+        train_articles_num = int(total_articles * 0.8)
+        dev_articles_num = int(total_articles * 0.1)
+        fname, ext = os.path.splitext(args.samples_file)
+        files = {'train': fname + '-train' + ext}
+        if not args.known_entities_only:
+            files['dev'] = fname + '-dev' + ext
+            files['test'] = fname + '-test' + ext
+        else:
+            files['dev'] = fname + '-dev-known' + ext
+            files['test'] = fname + '-test-known' + ext
+    else:
+        files = {'total': args.samples_file}
+    samples_num = {split: 0 for split in files}
+    # entities in train set
+    known_entities = set()
+    removed = {'dev': 0, 'test': 0}
+
+    with ExitStack() as stack, open(args.dataset_file) as f:
+        outputs = {split: stack.enter_context(open(filename, 'w')) for split, filename in files.items()}
+        for line_no, line in enumerate(tqdm(f, total=lines, desc='generate samples')):
+            if line_no in skip_lines:
+                continue
+            content, epos, all_entities_ids, pairs_entities_ids, all_mismatch, tie_mismatch = \
+                tag_article(json.loads(line), entity2id, args)
+            all_entities_mismatch += all_mismatch
+            tie_entities_mismatch += tie_mismatch
             if len(pairs_entities_ids) == 0:
                 continue
 
+            if not args.split:
+                split = 'total'
+            elif num_articles < train_articles_num:
+                split = 'train'
+            elif num_articles < train_articles_num + dev_articles_num:
+                split = 'dev'
+            else:
+                split = 'test'
+
             # make negative samples and select sentences
             article_pos_num = 0
             article_samples_num = 0
-            article_samples = []
-            for src, tgt in permutations(all_entities_ids, 2):
-                if not args.ignore_direction:
-                    label = 1 if (src, tgt) in pairs_entities_ids else 0
-                else:
-                    label = 1 if (src, tgt) in pairs_entities_ids or (tgt, src) in pairs_entities_ids else 0
-                if label == 1:
+            article_written = False
+            for sample in article_samples(content, epos, all_entities_ids, pairs_entities_ids, args):
+                src, tgt = sample['src'], sample['tgt']
+                if sample['label'] == 1:
                     article_pos_num += 1
+                    blame_tie_dist.add(min((abs(si - ti) for (si, _), (ti, _) in zip(epos[src], epos[tgt]))))
                 article_samples_num += 1
-                sent_idxs = {si for si, _ in epos[src] + epos[tgt]}
-                sents = [content[si] for si in sent_idxs]
-                s_pos = [(sents.index(content[si]), wi) for si, wi in epos[src]]
-                t_pos = [(sents.index(content[si]), wi) for si, wi in epos[tgt]]
-                sample = {'src_pos': s_pos, 'tgt_pos': t_pos,
-                          'src_pos_original': epos[src], 'tgt_pos_original': epos[tgt],
-                          'src': src, 'tgt': tgt,
-                          'sents': sents, 'label': label}
-                article_samples.append(sample)
-
-                if label == 1:
-                    blame_tie_dist.append(min((abs(si - ti) for (si, _), (ti, _) in zip(epos[src], epos[tgt]))))
+
+                if split == 'train':
+                    known_entities.add(src)
+                    known_entities.add(tgt)
+                elif split in removed and args.known_entities_only:
+                    # filter out unknown entities in dev and test
+                    if src not in known_entities or tgt not in known_entities:
+                        removed[split] += 1
+                        continue
+                if not article_written:
+                    # the article's sentences, once before its samples
+                    outputs[split].write(json.dumps({'id': num_articles, 'sents': content}) + '\n')
+                    article_written = True
+                sample['article'] = num_articles
+                samples_num[split] += 1
+                outputs[split].write(json.dumps(sample) + '\n')
             assert article_pos_num > 0
 
             num_pos_samples += article_pos_num
             num_samples += article_samples_num
             num_articles += 1
-            num_entities_dist.append(len(all_entities_ids))
-            samples_ratio_dist.append((article_samples_num - article_pos_num) / article_pos_num)
-            samples.append(article_samples)
-
-    if args.split:
-        train_articles_num = int(num_articles * 0.8)
-        dev_articles_num = int(num_articles * 0.1)
-
-        train_articles_samples = samples[:train_articles_num]
-        dev_articles_samples = samples[train_articles_num:train_articles_num + dev_articles_num]
-        test_articles_samples = samples[train_articles_num + dev_articles_num:]
-
-        if args.known_entities_only:
-            # find entities in train set
-            known_entities = set()
-            for article in train_articles_samples:
-                for sample in article:
-                    src_si, src_wi = sample['src_pos'][0]
-                    src = sample['sents'][src_si][src_wi]
-                    tgt_si, tgt_wi = sample['tgt_pos'][0]
-                    tgt = sample['sents'][tgt_si][tgt_wi]
-                    known_entities.add(src)
-                    known_entities.add(tgt)
+            num_entities_dist.add(len(all_entities_ids))
+            samples_ratio_dist.add((article_samples_num - article_pos_num) / article_pos_num)
 
-            # filter out unknown entities in dev
-            dev_articles_samples_filtered = []
-            dev_removed, dev_remains = 0, 0
-            for article in dev_articles_samples:
-                article_filtered = []
-                for sample in article:
-                    src_si, src_wi = sample['src_pos'][0]
-                    src = sample['sents'][src_si][src_wi]
-                    tgt_si, tgt_wi = sample['tgt_pos'][0]
-                    tgt = sample['sents'][tgt_si][tgt_wi]
-                    if src in known_entities and tgt in known_entities:
-                        article_filtered.append(sample)
-                        dev_remains += 1
-                    else:
-                        dev_removed += 1
-                if article_filtered:
-                    dev_articles_samples_filtered.append(article_filtered)
-            dev_articles_samples = dev_articles_samples_filtered
-
-            # filter out unknown entities in test
-            test_articles_samples_filtered = []
-            test_removed, test_remains = 0, 0
-            for article in test_articles_samples:
-                article_filtered = []
-                for sample in article:
-                    src_si, src_wi = sample['src_pos'][0]
-                    src = sample['sents'][src_si][src_wi]
-                    tgt_si, tgt_wi = sample['tgt_pos'][0]
-                    tgt = sample['sents'][tgt_si][tgt_wi]
-                    if src in known_entities and tgt in known_entities:
-                        article_filtered.append(sample)
-                        test_remains += 1
-                    else:
-                        test_removed += 1
-                if article_filtered:
-                    test_articles_samples_filtered.append(article_filtered)
-            test_articles_samples = test_articles_samples_filtered
-            print(colored(f'Removed dev {dev_removed} samples. {dev_remains} dev samples', 'yellow'))
-            print(colored(f'Removed test {test_removed} samples. {test_remains} test samples', 'yellow'))
-
-        fname, ext = os.path.splitext(args.samples_file)
-        train_file = fname + '-train' + ext
-        if not args.known_entities_only:
-            dev_file = fname + '-dev' + ext
-            test_file = fname + '-test' + ext
-        else:
-            dev_file = fname + '-dev-known' + ext
-            test_file = fname + '-test-known' + ext
-
-        train_samples_num = 0
-        with open(train_file, 'w') as f:
-            for article_sample in tqdm(train_articles_samples, total=len(train_articles_samples), desc='write train'):
-                for sample in article_sample:
-                    train_samples_num += 1
-                    f.write(json.dumps(sample) + '\n')
-        print(f'{train_samples_num} samples written to {train_file}.')
-        dev_samples_num = 0
-        with open(dev_file, 'w') as f:
-            for article_sample in tqdm(dev_articles_samples, total=len(dev_articles_samples), desc='write dev'):
-                for sample in article_sample:
-                    dev_samples_num += 1
-                    f.write(json.dumps(sample) + '\n')
-        print(f'{dev_samples_num} samples written to {dev_file}.')
-        test_samples_num = 0
-        with open(test_file, 'w') as f:
-            for article_sample in tqdm(test_articles_samples, total=len(test_articles_samples), desc='write test'):
-                for sample in article_sample:
-                    test_samples_num += 1
-                    f.write(json.dumps(sample) + '\n')
-        print(f'{test_samples_num} samples written to {test_file}.')
-    else:
-        samples_num = 0
-        with open(args.samples_file, 'w') as fout:
-            for article_sample in tqdm(samples, total=len(samples), desc='write total'):
-                for sample in article_sample:
-                    samples_num += 1
-                    fout.write(json.dumps(sample) + '\n')
-        print(f'{samples_num} samples written to {args.samples_file}.')
+    if args.split and args.known_entities_only:
+        print(colored(f'Removed dev {removed["dev"]} samples. {samples_num["dev"]} dev samples', 'yellow'))
+        print(colored(f'Removed test {removed["test"]} samples. {samples_num["test"]} test samples', 'yellow'))
+    for split, filename in files.items():
+        print(f'{samples_num[split]} samples written to {filename}.')
 
     print(colored(f'mismatched entities: {all_entities_mismatch}.', 'yellow'))
     print(colored(f'mismatched blame entities: {tie_entities_mismatch}', 'yellow'))
 
     print(f'{num_articles} articles generate {num_samples} samples.')
-    print(f'avg entities per article: {mean(num_entities_dist):.2f} ± {stdev(num_entities_dist):.2f}')
-    print(f'avg neg/pos ratio per article: {mean(samples_ratio_dist):.2f} ± {stdev(samples_ratio_dist):.2f}')
+    print(f'avg entities per article: {num_entities_dist.mean:.2f} ± {num_entities_dist.stdev:.2f}')
+    print(f'avg neg/pos ratio per article: {samples_ratio_dist.mean:.2f} ± {samples_ratio_dist.stdev:.2f}')
     print(f'pos: {num_pos_samples}, neg: {num_samples-num_pos_samples}, '
           f'neg / pos = {(num_samples-num_pos_samples)/num_pos_samples:.2f}, '
           f'overall pos percentage: {num_pos_samples / num_samples * 100:.2f}%')
-    print(f'avg pair sentence distance: {mean(blame_tie_dist):.2f} ± {stdev(blame_tie_dist):.2f}')
+    print(f'avg pair sentence distance: {blame_tie_dist.mean:.2f} ± {blame_tie_dist.stdev:.2f}')
 
     if args.save_stats:
         with open('num_entities_dist.txt', 'w') as f:
-            f.write('\n'.join([str(e) for e in sorted(num_entities_dist, reverse=True)]))
+            f.write('\n'.join([str(e) for e in sorted(num_entities_dist.values, reverse=True)]))
         with open('samples_ratio_dist.txt', 'w') as f:
-            f.write('\n'.join([str(e) for e in sorted(samples_ratio_dist, reverse=True)]))
+            f.write('\n'.join([str(e) for e in sorted(samples_ratio_dist.values, reverse=True)]))
         with open('blame_tie_dist.txt', 'w') as f:
-            f.write('\n'.join([str(e) for e in sorted(blame_tie_dist, reverse=True)]))
+            f.write('\n'.join([str(e) for e in sorted(blame_tie_dist.values, reverse=True)]))
 
     if args.plt_stats:
         import matplotlib.pyplot as plt
         import seaborn as sns
         plt.figure()
-        sns.distplot(num_entities_dist)
+        sns.distplot(num_entities_dist.values)
         plt.show()
         plt.figure()
-        sns.distplot(samples_ratio_dist)
+        sns.distplot(samples_ratio_dist.values)
         plt.show()
         plt.figure()
-        sns.distplot(blame_tie_dist)
+        sns.distplot(blame_tie_dist.values)
         plt.show()
 
 
@@ -97,6 +97,8 @@ def add_train_args(parser):
                        default=None, help='pretrained embeddings file/elmo')
     files.add_argument('--valid-size', type=float, default=0.1,
                        help='validation set ratio')
+    files.add_argument('--data-cache', type=str, default='compiled',
+                       help='Directory in data-dir of the vectorized data files. Empty to disable.')
 
     # General
     general = parser.add_argument_group('General')
@@ -109,6 +111,8 @@ def add_train_args(parser):
                          help='The evaluation metric used for model selection')
     general.add_argument('--uncased', type='bool', default=True,
                          help='uncase data')
+    general.add_argument('--article-mode', type='bool', default=False,
+                         help='Batch whole articles: encode each article once and score all its pairs')
     general.add_argument('--vocab-cutoff', type=int, default=1,
                          help='word frequency larger than this will be in dictionary')
     general.add_argument('--visdom', type='bool', default=True,
@@ -139,6 +143,18 @@ def set_defaults(args):
         if not os.path.isfile(args.test_file):
             raise IOError('No such file: %s' % args.test_file)
 
+    if args.data_cache:
+        args.data_cache = os.path.join(args.data_dir, args.data_cache)
+
+    if args.article_mode:
+        if not args.test_file:
+            raise RuntimeError('article_mode needs a test_file, '
+                               'cross validation is by pair.')
+        if args.weighted_sampling:
+            logger.warning('WARN: weighted_sampling set to False '
+                           'as article_mode samples articles.')
+            args.weighted_sampling = False
+
     if args.pretrain_file:
         if args.pretrain_file in ['w2v', 'glove']:
             if args.pretrain_file == 'w2v':
@@ -471,8 +487,12 @@ def main(args):
             dev_exs = dev_exs[:3]
             test_exs = test_exs[:3]
         model = initialize_model(train_exs, dev_exs, test_exs)
-        train_loader, dev_loader, test_loader = utils.split_loader(train_exs, test_exs, args, model,
-                                                                   dev_exs=dev_exs, weighted=args.weighted_sampling)
+        if args.article_mode:
+            train_loader, dev_loader, test_loader = utils.split_loader_articles(train_exs, test_exs, args, model,
+                                                                                dev_exs=dev_exs)
+        else:
+            train_loader, dev_loader, test_loader = utils.split_loader(train_exs, test_exs, args, model,
+                                                                       dev_exs=dev_exs, weighted=args.weighted_sampling)
         result = train_valid_loop(train_loader, dev_loader, test_loader, args, model)[args.valid_metric]
         logger.info('-' * 100)
         logger.info(f'Test {args.valid_metric}: {result*100:.2f}%')
@@ -12,7 +12,6 @@ Generate samples in the format: ([ent-pos, ent-label] sents)
 '''
 
 import argparse
-from collections import defaultdict
 from collections import Counter
 import os
 import json
@@ -23,6 +22,8 @@ from tqdm import tqdm
 
 
 from blamepipeline import DATA_DIR as DATA_ROOT
+from blamepipeline.preprocess.entity_merge import entity_merge
+from blamepipeline.preprocess.entity_tag import EntityTagger
 
 DATA_DIR = os.path.join(DATA_ROOT, 'datasets')
 
@@ -51,36 +52,7 @@ def entity_merge_global(args):
         for line in f:
             all_ents |= {tuple(e) for e in json.loads(line)['entities']}
 
-    # one step transform
-    transform_d = {}
-    for e in tqdm(all_ents, total=len(all_ents), desc='find transforms'):
-        for e_ in all_ents:
-            if len(e) <= 1 or e == e_:
-                continue
-            if ' '.join(e) in ' '.join(e_):
-                transform_d[e] = e_
-                e = e_
-            elif ' '.join(e_) in ' '.join(e):
-                transform_d[e_] = e
-            elif len(e) == 2 and len(e_) == 3 and e[0] == e_[0] and e[-1] == e_[-1] and e_[1].endswith('.'):
-                # middle name
-                transform_d[e] = e_
-                print(f'{e} -> {e_}')
-            elif len(e) == 3 and len(e_) == 2 and e[0] == e_[0] and e[-1] == e_[-1] and e[1].endswith('.'):
-                transform_d[e_] = e
-                print(f'{e_} -> {e}')
-
-    # construct dict
-    entity2id = {}
-    entity2alias = defaultdict(set)
-    for e in all_ents:
-        e_ = e
-        while e_ in transform_d:
-            e_ = transform_d[e_]
-        entity2id[e] = ' '.join(e_)
-        entity2alias[e_].add(e)
-    # sort by entity len
-    entity2alias = {e: sorted(alias, key=lambda t: -len(t)) for e, alias in entity2alias.items()}
+    entity2id, entity2alias = entity_merge(all_ents)
     # save
     with open(entity_json_path, 'w') as entity_j,\
             open(entity_txt_path, 'w') as entity_t:
@@ -97,30 +69,7 @@ def entity_merge_global(args):
 
 
 def entity_merge_local(entities):
-    # one step transform
-    transform_d = {}
-    for e in entities:
-        for e_ in entities:
-            if len(e) <= 1 or e == e_:
-                continue
-            if ' '.join(e) in ' '.join(e_):
-                transform_d[e] = e_
-                e = e_
-            elif ' '.join(e_) in ' '.join(e):
-                transform_d[e_] = e
-            elif len(e) == 2 and len(e_) == 3 and e[0] == e_[0] and e[-1] == e_[-1] and e_[1].endswith('.'):
-                # middle name
-                transform_d[e] = e_
-            elif len(e) == 3 and len(e_) == 2 and e[0] == e_[0] and e[-1] == e_[-1] and e[1].endswith('.'):
-                transform_d[e_] = e
-    entity2id = {}
-    entity2alias = defaultdict(set)
-    for e in entities:
-        e_ = e
-        while e_ in transform_d:
-            e_ = transform_d[e_]
-        entity2id[e] = ' '.join(e_)
-        entity2alias[e_].add(e)
+    entity2id, _ = entity_merge(entities)
     return entity2id
 
 
@@ -152,24 +101,8 @@ def main(args):
             # merge entity words in *content* into a single token, and replace by id
             # sorted ents by word len to avoid mismatch
             all_entities = sorted(all_entities, key=lambda t: -len(t))
-            epos = defaultdict(list)
-            for si, s in enumerate(content):
-                wi = 0
-                while wi < len(s):
-                    for e in all_entities:
-                        e_list, e_len = list(e), len(e)
-                        if s[wi: wi + e_len] == e_list or\
-                                s[wi: wi + e_len - 1] == e_list[:-1] and s[wi + e_len - 1] == e_list[-1] + '.':
-                            s[wi: wi + e_len] = [entity2id[e]]
-                            break
-                    wi += 1
-
-            # find positions for entities
-            epos = defaultdict(list)
-            for si, s in enumerate(content):
-                for wi, w in enumerate(s):
-                    if w in all_entities_ids:
-                        epos[w].append((si, wi))
+            # and find positions for entities
+            epos = EntityTagger(all_entities, entity2id).tag(content)
 
             # # remove entities which cannot be found in article
             all_entities_ids = sorted({e for e in all_entities_ids if e in epos})
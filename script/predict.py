@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Predict the blame ties of raw articles with a trained blameextract model.
+
+Articles are text files (one article per file) or JSONL files of records
+with the text in 'content'. Every ordered pair of the persons and
+organizations of an article is scored, and a JSON record per article is
+written with its ties ({'source', 'target', 'score'}) of score >= threshold.
+'''
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import torch
+
+from blamepipeline import tokenizers
+from blamepipeline.blameextract.model import BlameExtractor
+from blamepipeline.pipeline import BlamePipeline
+
+logger = logging.getLogger()
+
+
+def read_articles(files, input_format):
+    '''
+    Yield the articles of files, '-' is stdin.
+    '''
+    for filename in files:
+        fmt = input_format
+        if fmt == 'auto':
+            fmt = 'jsonl' if filename.endswith(('.jsonl', '.json')) else 'text'
+        f = sys.stdin if filename == '-' else open(filename, encoding='utf-8')
+        try:
+            if fmt == 'text':
+                yield {'id': filename, 'content': f.read()}
+            else:
+                for line_no, line in enumerate(f):
+                    if not line.strip():
+                        continue
+                    article = json.loads(line)
+                    article.setdefault('id', f'{filename}:{line_no}')
+                    yield article
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def main(args):
+    device = torch.device(f'cuda:{args.gpu}' if args.cuda else 'cpu')
+    model = BlameExtractor.load(args.model)
+    model.to(device)
+
+    tokenizer_opts = {'annotators': {'ner'}}
+    if args.corenlp_url:
+        tokenizer_opts['url'] = args.corenlp_url
+    tokenizer_class = tokenizers.get_class(args.tokenizer)
+    if args.num_workers > 1:
+        tokenizer = tokenizers.TokenizerPool(tokenizer_class, args.num_workers, tokenizer_opts)
+    else:
+        tokenizer = tokenizer_class(**tokenizer_opts)
+
+    pipeline = BlamePipeline(model, tokenizer, batch_size=args.batch_size, chunk_size=args.chunk_size,
+                             queue_size=args.queue_size, uncased=args.uncased)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    start = time.time()
+    num_articles, num_pairs, num_ties = 0, 0, 0
+    try:
+        for article, ties in pipeline.run(read_articles(args.files, args.input_format)):
+            record = {k: v for k, v in article.items() if k != 'content'}
+            record['ties'] = [{'source': src, 'target': tgt, 'score': score}
+                              for src, tgt, score in ties if score >= args.threshold]
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+            num_articles += 1
+            num_pairs += len(ties)
+            num_ties += len(record['ties'])
+    finally:
+        tokenizer.shutdown()
+        if output is not sys.stdout:
+            output.close()
+    logger.info(f'{num_articles} articles, {num_pairs} pairs scored, {num_ties} blame ties '
+                f'in {time.time() - start:.2f} (s).')
+
+
+def str2bool(v):
+    return v.lower() in ('yes', 'true', 't', '1', 'y')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict blame ties of raw articles',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.register('type', 'bool', str2bool)
+    parser.add_argument('files', nargs='+', help='article text or JSONL files, - for stdin')
+    parser.add_argument('--model', type=str, required=True, help='blameextract model file (.mdl)')
+    parser.add_argument('--output', type=str, default='-', help='JSONL output file, - for stdout')
+    parser.add_argument('--input-format', type=str, default='auto', choices=['auto', 'text', 'jsonl'],
+                        help='format of the files, auto by extension (.jsonl/.json)')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='minimum score of the written ties, 0 for all pairs')
+    parser.add_argument('--uncased', type='bool', default=False, help='lowercase the articles')
+    # tokenizer
+    parser.add_argument('--tokenizer', type=str, default='corenlp',
+                        choices=['corenlp', 'corenlp_server', 'spacy'],
+                        help='corenlp_server keeps several articles in flight on a CoreNLP server')
+    parser.add_argument('--corenlp-url', type=str, default=None,
+                        help='URL of a CoreNLP server, for the corenlp_server tokenizer')
+    parser.add_argument('--num-workers', type=int, default=1, help='tokenizer processes')
+    # pipeline
+    parser.add_argument('--batch-size', type=int, default=16, help='articles scored per batch')
+    parser.add_argument('--chunk-size', type=int, default=8, help='articles tokenized per batch')
+    parser.add_argument('--queue-size', type=int, default=64, help='articles buffered between stages')
+    # runtime
+    parser.add_argument('--no-cuda', type='bool', default=False, help='Run on CPU, even if GPUs are available.')
+    parser.add_argument('--gpu', type=int, default=0, help='Run on a specific GPU')
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    logger.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+    console = logging.StreamHandler()
+    console.setFormatter(fmt)
+    logger.addHandler(console)
+
+    main(args)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Convert text embedding files (GloVe, word2vec) to the binary format that
+model.load_embeddings memory-maps instead of parsing the text.
+'''
+
+import argparse
+import os
+import time
+
+from blamepipeline import DATA_DIR
+from blamepipeline.embeddings import convert, store_paths
+
+EMBED_DIR = os.path.join(DATA_DIR, 'embeddings')
+
+
+def main(args):
+    for filename in args.files:
+        filename = os.path.join(args.embed_dir, filename)
+        start = time.time()
+        num, dim = convert(filename)
+        print(f'{filename}: {num} vectors of dim {dim} written to '
+              f'{", ".join(store_paths(filename))} in {time.time() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert text embeddings to binary')
+    parser.add_argument('files', nargs='+', help='text embedding files, e.g. glove.6B.100d.txt')
+    parser.add_argument('--embed-dir', type=str, default=EMBED_DIR,
+                        help='directory of the embedding files')
+    args = parser.parse_args()
+    main(args)
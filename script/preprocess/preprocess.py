@@ -10,6 +10,7 @@ Load raw data, preprocess and save to file.
 '''
 
 import argparse
+import hashlib
 import os
 import json
 # import re
@@ -23,7 +24,8 @@ from stanfordcorenlp import StanfordCoreNLP
 from blamepipeline import DATA_DIR
 from blamepipeline.preprocess.match_article_entry import match_data
 from blamepipeline.preprocess.match_entity_article import filter_data
-from blamepipeline.tokenizers import CoreNLPTokenizer
+from blamepipeline.preprocess.entity_extract import ner_entities, tokenize_entity, tokenize_entities
+from blamepipeline import tokenizers
 
 DATASET = os.path.join(DATA_DIR, 'Jan2013-2017/Hannity (opinion)/datasets')
 
@@ -40,17 +42,154 @@ def contains(entity_toks, article_toks):
     return False
 
 
-def tokenize_entity(tokenizer, entity):
+def article_fingerprint(key, content, ties, options):
     '''
-    Tokenize and clean the entity.
-    entitt: str
+    Fingerprint of everything a dataset record is built from.
     '''
-    # tokenize
-    entity = tuple(t for s in tokenizer.tokenize(entity).words() for t in s)
-    # clean
-    entity = entity[:-1] if entity[-1] == '.' else entity
-    entity = entity[1:] if entity[0] == '--' else entity
-    return entity
+    raw = json.dumps([list(key), content, ties, options], sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def load_manifest(manifest_file, dataset_file):
+    '''
+    Return {fingerprint: (offset, length)} of the records of dataset_file,
+    or {} if there is no manifest or the dataset changed since it was written.
+    '''
+    if not os.path.exists(manifest_file) or not os.path.exists(dataset_file):
+        return {}
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    stat = os.stat(dataset_file)
+    if manifest.get('size') != stat.st_size or manifest.get('mtime') != stat.st_mtime_ns:
+        print(colored(f'{dataset_file} changed since its manifest was written. Rebuilding.', 'yellow'))
+        return {}
+    return {fp: (offset, length) for fp, offset, length in manifest['records']}
+
+
+def save_manifest(manifest_file, dataset_file, records):
+    '''
+    records: [(fingerprint, offset, length)] of the lines of dataset_file.
+    '''
+    stat = os.stat(dataset_file)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'records': records}, f)
+    os.replace(tmp_file, manifest_file)
+
+
+def build_records(tokenizer, keys, articles_content, articles_tie, args):
+    '''
+    Tokenize the articles of keys and build their dataset records.
+    Return: ({key: record line}, {key: error}). Articles that fail are
+            reported as errors instead of aborting the run.
+    '''
+    errors = {}
+    contents = [articles_content[key] for key in keys]
+    if args.tokenize:
+        try:
+            tokenized = list(tokenizer.imap(contents))
+        except Exception:
+            # find the articles that fail by tokenizing them one at a time,
+            # on a fresh tokenizer: the failed one may still hold the output
+            # of the failed request, which would be read as the next result
+            tokenizer.reset()
+            tokenized = []
+            for key, content in zip(keys, contents):
+                try:
+                    tokenized.append(tokenizer.tokenize(content))
+                except Exception as e:
+                    errors[key] = f'tokenize: {e!r}'
+                    tokenized.append(None)
+                    tokenizer.reset()
+        # automatically generated entities
+        article_entities = {key: ner_entities(tokens)
+                            for key, tokens in zip(keys, tokenized) if tokens is not None}
+        # tokenize every distinct entity name once
+        names = sorted({e for key in article_entities for e in article_entities[key]} |
+                       {e for key in article_entities for d in articles_tie[key] for e in (d['source'], d['target'])})
+        try:
+            entity_tokens = dict(zip(names, tokenize_entities(tokenizer, names)))
+        except Exception:
+            tokenizer.reset()
+            entity_tokens = {}
+            for name in names:
+                try:
+                    entity_tokens[name] = tokenize_entity(tokenizer, name)
+                except Exception as e:
+                    entity_tokens[name] = e
+                    tokenizer.reset()
+
+    records = {}
+    for i, key in enumerate(keys):
+        if key in errors:
+            continue
+        title, date = key
+        ties = articles_tie[key]
+        entities = []
+        content = contents[i]
+        if args.tokenize:
+            # annotated entities
+            anno_entities = {e for d in ties for e in (d['source'], d['target'])}
+            # toknenize all_entities
+            all_entities = {entity_tokens[e] for e in article_entities[key] | anno_entities}
+            failed = [e for e in all_entities if isinstance(e, Exception)]
+            if failed:
+                errors[key] = f'tokenize entity: {failed[0]!r}'
+                continue
+            content = tokenized[i].words(uncased=args.uncased)
+            missing = [e for e in all_entities if not contains(list(e), content)]
+            if missing:
+                print(colored(f'{missing[0]} not in {key}!', 'red'))
+                errors[key] = f'{missing[0]} not in content'
+                continue
+            # combine entities
+            entities = list(all_entities)
+            # tokenize blame tie entities
+            ties = [{'source': entity_tokens[d['source']],
+                     'target': entity_tokens[d['target']],
+                     'claim': d['claim']}
+                    for d in ties]
+        d = {'title': title,
+             'date': date,
+             'pairs': ties,
+             'entities': entities,
+             'content': content}
+        records[key] = (json.dumps(d) + '\n').encode('utf-8')
+    return records, errors
+
+
+def load_journal(journal_file):
+    '''
+    Return {shard number: journal entry} of the shards committed so far.
+    '''
+    done = {}
+    if os.path.exists(journal_file):
+        with open(journal_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn last line of a crashed run
+                    continue
+                done[entry['shard']] = entry
+    return done
+
+
+def commit(tmp_file, filename):
+    '''
+    Flush tmp_file to disk and move it to filename atomically.
+    '''
+    with open(tmp_file, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
+
+
+def shutdown_tokenizer(tokenizer, args):
+    if args.tokenize_cache:
+        stats = tokenizer.stats()
+        print(f'tokenize cache: {stats["hits"]} hits, {stats["misses"]} misses '
+              f'({stats["hit_rate"]*100:.2f}%), {stats["entries"]} entries')
+    tokenizer.shutdown()
 
 
 def main(args):
@@ -64,26 +203,43 @@ def main(args):
     for source in sources:
         print('-' * 100)
         print(source)
-        pairs = match_data(source)
+        pairs = match_data(source, workers=args.ingest_workers)
         print('{} pairs loaded.'.format(len(pairs)))
         valid_pairs = filter_data(pairs, source=source, ignore_claim=args.ignore_claim)
         print('{} valid pairs.'.format(len(valid_pairs)))
         data += valid_pairs
     print(f'{len(data)} valid pairs in total.')
-    tokenizer = CoreNLPTokenizer(annotators={'ner'},)
+    tokenizer_opts = {'annotators': {'ner'}}
+    if args.corenlp_url:
+        tokenizer_opts['url'] = args.corenlp_url
+    tokenizer_class = tokenizers.get_class(args.tokenizer)
+    if args.num_workers > 1:
+        tokenizer = tokenizers.TokenizerPool(tokenizer_class, args.num_workers, tokenizer_opts)
+    else:
+        tokenizer = tokenizer_class(**tokenizer_opts)
+    if args.tokenize_cache:
+        tokenizer = tokenizers.CachedTokenizer(tokenizer, os.path.join(DATASET, args.tokenize_cache),
+                                               max_size=args.tokenize_cache_size << 20,
+                                               options=tokenizer_class.output_options(tokenizer_opts))
     dataset_file = os.path.join(DATASET, 'dataset.json')
 
     if not args.cluster_article:
         # don't need to cluster by article. use when training claim centence classification
         pbar = tqdm(data, desc='tokenize') if args.tqdm and args.tokenize else data
-        with open(dataset_file, 'w') as f:
-            for d in pbar:
-                if args.tokenize:
-                    if d['claim']:
-                        d['claim'] = tokenizer.tokenize(d['claim']).words(uncased=args.uncased)
-                    d['content'] = tokenizer.tokenize(d['content']).words(uncased=args.uncased)
-                    print(d['content'])
-                f.write(json.dumps(d) + '\n')
+        try:
+            with open(dataset_file, 'w') as f:
+                for d in pbar:
+                    if args.tokenize:
+                        if d['claim']:
+                            claim, content = tokenizer.tokenize_batch([d['claim'], d['content']])
+                            d['claim'] = claim.words(uncased=args.uncased)
+                        else:
+                            content = tokenizer.tokenize(d['content'])
+                        d['content'] = content.words(uncased=args.uncased)
+                        print(d['content'])
+                    f.write(json.dumps(d) + '\n')
+        finally:
+            shutdown_tokenizer(tokenizer, args)
     else:
         # clustering by article
         articles_tie = defaultdict(list)
@@ -98,42 +254,91 @@ def main(args):
         print('-' * 100)
         print(f'{len(data)} valid pairs in {len(articles_tie)} articles.')
 
-        # tokenize
-        article_ents = {}
-        if args.tokenize:
-            # tokenize article
-            for key in tqdm(articles_content, total=len(articles_content), desc='tokenize'):
-                # for each article
-                # tokenize content
-                tokenized = tokenizer.tokenize(articles_content[key])
-                articles_content[key] = tokenized.words(uncased=args.uncased)
-                # automatically generated entities
-                ner_entities = {name for name, tag in tokenized.entity_groups()
-                                if tag in {'ORGANIZATION', 'PERSON'} and len(name) >= 2}
-                # annotated entities
-                anno_entities = {e for d in articles_tie[key] for e in (d['source'], d['target'])}
-                # toknenize all_entities
-                all_entities = {tokenize_entity(tokenizer, e) for e in ner_entities | anno_entities}
-
-                for e in all_entities:
-                    assert contains(list(e), articles_content[key]), colored(f'{e} not in {key}!', 'red')
-                # combine entities
-                article_ents[key] = list(all_entities)
-                # tokenize blame tie entities
-                articles_tie[key] = [{'source': tokenize_entity(tokenizer, d['source']),
-                                      'target': tokenize_entity(tokenizer, d['target']),
-                                      'claim': d['claim']}
-                                     for d in articles_tie[key]]
-        # write into file
-        with open(dataset_file, 'w') as f:
-            for key in articles_tie:
-                title, date = key
-                d = {'title': title,
-                     'date': date,
-                     'pairs': articles_tie[key],
-                     'entities': article_ents[key],
-                     'content': articles_content[key]}
-                f.write(json.dumps(d) + '\n')
+        # find the records that can be reused from the last run
+        manifest_file = os.path.join(DATASET, 'dataset.manifest.json')
+        options = {'tokenize': args.tokenize, 'tokenizer': args.tokenizer, 'uncased': args.uncased}
+        fingerprints = {key: article_fingerprint(key, articles_content[key], articles_tie[key], options)
+                        for key in articles_tie}
+        previous = load_manifest(manifest_file, dataset_file) if args.incremental else {}
+        if args.incremental:
+            changed = sum(1 for key in articles_tie if fingerprints[key] not in previous)
+            print(f'{len(articles_tie) - changed} unchanged articles reused, {changed} to process.')
+
+        # Records are written in shards of shard_size articles. A shard is
+        # committed atomically and then logged in the journal, so a restarted
+        # run skips the shards already done.
+        shard_dir = os.path.join(DATASET, 'dataset.shards')
+        journal_file = os.path.join(shard_dir, 'journal.jsonl')
+        rejects_file = os.path.join(DATASET, 'dataset.rejects.jsonl')
+        os.makedirs(shard_dir, exist_ok=True)
+        done = load_journal(journal_file)
+        all_keys = list(articles_tie)
+        shards = [all_keys[i: i + args.shard_size] for i in range(0, len(all_keys), args.shard_size)]
+        journal = []
+        old = open(dataset_file, 'rb') if previous else None
+        try:
+            with open(journal_file, 'a') as journal_f:
+                for shard_no, shard_keys in enumerate(tqdm(shards, desc='shards')):
+                    shard_fp = hashlib.sha1(''.join(fingerprints[key] for key in shard_keys)
+                                            .encode('utf-8')).hexdigest()
+                    shard_file = os.path.join(shard_dir, f'shard-{shard_no:05d}.json')
+                    entry = done.get(shard_no)
+                    if entry and entry['fingerprint'] == shard_fp and os.path.exists(shard_file):
+                        journal.append(entry)
+                        continue
+
+                    keys = [key for key in shard_keys if fingerprints[key] not in previous]
+                    records, errors = build_records(tokenizer, keys, articles_content, articles_tie, args)
+                    written, rejects = [], []
+                    with open(shard_file + '.tmp', 'wb') as f:
+                        for key in shard_keys:
+                            fp = fingerprints[key]
+                            if fp in previous:
+                                offset, length = previous[fp]
+                                old.seek(offset)
+                                line = old.read(length)
+                            elif key in records:
+                                line = records[key]
+                            else:
+                                rejects.append({'title': key[0], 'date': key[1], 'error': errors[key],
+                                                'pairs': articles_tie[key], 'content': articles_content[key]})
+                                continue
+                            f.write(line)
+                            written.append((fp, len(line)))
+                    commit(shard_file + '.tmp', shard_file)
+                    entry = {'shard': shard_no, 'fingerprint': shard_fp, 'records': written, 'rejects': rejects}
+                    journal_f.write(json.dumps(entry) + '\n')
+                    journal_f.flush()
+                    os.fsync(journal_f.fileno())
+                    journal.append(entry)
+        finally:
+            if old is not None:
+                old.close()
+            shutdown_tokenizer(tokenizer, args)
+
+        # quarantined articles
+        rejects = [r for entry in journal for r in entry['rejects']]
+        with open(rejects_file + '.tmp', 'w') as f:
+            for r in rejects:
+                f.write(json.dumps(r) + '\n')
+        commit(rejects_file + '.tmp', rejects_file)
+        if rejects:
+            print(colored(f'{len(rejects)} articles rejected, see {rejects_file}', 'red'))
+
+        # concatenate the shards into dataset.json
+        manifest = []
+        with open(dataset_file + '.tmp', 'wb') as f:
+            for shard_no, entry in enumerate(journal):
+                shard_file = os.path.join(shard_dir, f'shard-{shard_no:05d}.json')
+                with open(shard_file, 'rb') as shard_f:
+                    for fp, length in entry['records']:
+                        manifest.append((fp, f.tell(), length))
+                        f.write(shard_f.read(length))
+        commit(dataset_file + '.tmp', dataset_file)
+        save_manifest(manifest_file, dataset_file, manifest)
+        for name in os.listdir(shard_dir):
+            os.remove(os.path.join(shard_dir, name))
+        os.rmdir(shard_dir)
         print(f'Dataset saved to {dataset_file}')
 
 
@@ -147,10 +352,28 @@ if __name__ == '__main__':
     parser.add_argument('--source', type=str, default='all', choices=['fox', 'all'])
     parser.add_argument('--uncased', type='bool', default=False)
     parser.add_argument('--tokenize', type='bool', default=True)
+    parser.add_argument('--tokenizer', type=str, default='corenlp',
+                        choices=['corenlp', 'corenlp_server', 'spacy'],
+                        help='corenlp_server keeps several articles in flight on a CoreNLP server')
+    parser.add_argument('--corenlp-url', type=str, default=None,
+                        help='address of a running CoreNLP server (corenlp_server only)')
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='number of tokenizer processes')
+    parser.add_argument('--ingest-workers', type=int, default=1,
+                        help='number of processes parsing the article dumps')
+    parser.add_argument('--tokenize-cache', type=str, default='tokenize_cache.db',
+                        help='tokenization cache file in the dataset dir. empty to disable.')
+    parser.add_argument('--tokenize-cache-size', type=int, default=2048,
+                        help='tokenization cache size bound in MB')
     parser.add_argument('--ignore-claim', type='bool', default=True,
                         help='ignore existence of claim when filtering data entries.')
     parser.add_argument('--cluster-article', type='bool', default=True,
                         help='cluster blame ties in the same articles')
+    parser.add_argument('--shard-size', type=int, default=500,
+                        help='articles per committed shard (with --cluster-article)')
+    parser.add_argument('--incremental', type='bool', default=False,
+                        help='reuse the records of unchanged articles from the last dataset.json '
+                             '(with --cluster-article)')
     # others
     parser.add_argument('--tqdm', type='bool', default=True)
     args = parser.parse_args()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Serve a trained blameextract model over HTTP, see blamepipeline.service.
+Load test it with script/benchmark/load_test.py.
+'''
+
+import argparse
+import asyncio
+import logging
+
+import torch
+
+from blamepipeline import tokenizers
+from blamepipeline.blameextract.model import BlameExtractor
+from blamepipeline.service import BlameService
+
+logger = logging.getLogger()
+
+
+def main(args):
+    device = torch.device(f'cuda:{args.gpu}' if args.cuda else 'cpu')
+    model = BlameExtractor.load(args.model)
+    model.to(device)
+
+    tokenizer = None
+    if args.tokenizer != 'none':
+        tokenizer_opts = {'annotators': {'ner'}}
+        if args.corenlp_url:
+            tokenizer_opts['url'] = args.corenlp_url
+        tokenizer = tokenizers.get_class(args.tokenizer)(**tokenizer_opts)
+
+    service = BlameService(model, tokenizer, max_batch_size=args.max_batch_size,
+                           max_wait=args.max_wait_ms / 1000, uncased=args.uncased)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if tokenizer is not None:
+            tokenizer.shutdown()
+
+
+def str2bool(v):
+    return v.lower() in ('yes', 'true', 't', '1', 'y')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve blame tie scoring over HTTP',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.register('type', 'bool', str2bool)
+    parser.add_argument('--model', type=str, required=True, help='blameextract model file (.mdl)')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32, help='most requests scored at once')
+    parser.add_argument('--max-wait-ms', type=float, default=10,
+                        help='milliseconds a request waits for others to batch with')
+    parser.add_argument('--uncased', type='bool', default=False, help='lowercase the articles')
+    # tokenizer
+    parser.add_argument('--tokenizer', type=str, default='corenlp',
+                        choices=['corenlp', 'corenlp_server', 'spacy', 'none'],
+                        help='tokenizer of the articles, none to serve pairs only')
+    parser.add_argument('--corenlp-url', type=str, default=None,
+                        help='URL of a CoreNLP server, for the corenlp_server tokenizer')
+    # runtime
+    parser.add_argument('--no-cuda', type='bool', default=False, help='Run on CPU, even if GPUs are available.')
+    parser.add_argument('--gpu', type=int, default=0, help='Run on a specific GPU')
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    logger.setLevel(logging.INFO)
+    fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+    console = logging.StreamHandler()
+    console.setFormatter(fmt)
+    logger.addHandler(console)
+
+    main(args)